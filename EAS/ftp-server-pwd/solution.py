@@ -7,6 +7,65 @@ import sys
 from io import StringIO
 import zlib
 import os
+import time
+
+# close clients that have not sent a command for this many seconds
+IDLE_TIMEOUT = 300
+# a command that has started arriving must be complete within this time
+READ_TIMEOUT = 30
+
+class TimerWheel:
+    """Hashed timer wheel, O(1) schedule and cancel of deadlines keyed by any hashable"""
+    def __init__(self, tick=0.5, span=300):
+        # one lap of the wheel covers span seconds, so a timeout up to span
+        # never shares its slot with a key due a lap later
+        self.tick = tick
+        self.slots = [{} for _ in range(int(-(-span // tick)) + 1)]
+        self.timers = {}
+        self.current = int(time.monotonic() / tick)
+        # no slot before this tick is occupied, next_timeout starts here
+        self.cursor = self.current + 1
+
+    def schedule(self, key, timeout):
+        """(Re)arm the deadline for key, rounded up to the next tick"""
+        self.cancel(key)
+        expiry = max(int(-(-(time.monotonic() + timeout) // self.tick)), self.current + 1)
+        self.slots[expiry % len(self.slots)][key] = expiry
+        self.timers[key] = expiry
+        if expiry > self.current + len(self.slots):
+            # longer than a lap: its slot may come round before the cursor
+            self.cursor = self.current + 1
+        self.cursor = min(self.cursor, expiry)
+
+    def cancel(self, key):
+        expiry = self.timers.pop(key, None)
+        if expiry is not None:
+            del self.slots[expiry % len(self.slots)][key]
+
+    def next_timeout(self):
+        """Seconds until the next occupied slot, None when nothing is scheduled"""
+        if not self.timers:
+            return None
+        size = len(self.slots)
+        for t in range(max(self.cursor, self.current + 1), self.current + size + 1):
+            if self.slots[t % size]:
+                self.cursor = t
+                return max(0, t * self.tick - time.monotonic())
+
+    def expire(self):
+        """Remove and return the keys whose deadline has passed"""
+        now = int(time.monotonic() / self.tick)
+        size = len(self.slots)
+        expired = []
+        for t in range(self.current + 1, min(now, self.current + size) + 1):
+            slot = self.slots[t % size]
+            for key, expiry in list(slot.items()):
+                if expiry <= now:
+                    del slot[key]
+                    del self.timers[key]
+                    expired.append(key)
+        self.current = max(self.current, now)
+        return expired
 
 class FTPServer:
     def __init__(self, host='127.0.0.1', port=2000):
@@ -22,32 +81,51 @@ class FTPServer:
         self.sock = server_socket
         self.inputs = [self.sock]
         self.client_data = {}
+        # idle and read deadlines, keyed by (socket, kind)
+        self.timers = TimerWheel(span=max(IDLE_TIMEOUT, READ_TIMEOUT))
+
+    def close_client(self, s):
+        """Close a client connection and forget its state."""
+        s.close()
+        if s in self.inputs:
+            self.inputs.remove(s)
+        if s in self.client_data:
+            del self.client_data[s]
+        self.timers.cancel((s, 'idle'))
+        self.timers.cancel((s, 'read'))
 
     def start(self):
         while True:
-            readable, _, _ = select.select(self.inputs, [], [])
+            readable, _, _ = select.select(self.inputs, [], [], self.timers.next_timeout())
+
+            # drop idle clients and clients stuck halfway through a command
+            for s, kind in self.timers.expire():
+                print('Closing client,', kind, 'timeout')
+                self.close_client(s)
+
             for s in readable:
                 if s is self.sock:
                     client_socket, client_address = self.sock.accept()
                     client_socket.setblocking(False)
                     self.inputs.append(client_socket)
                     self.client_data[client_socket] = b''
-                else:
+                    self.timers.schedule((client_socket, 'idle'), IDLE_TIMEOUT)
+                elif s in self.client_data:
                     try:
                         data = s.recv(1024)
                         if data:
+                            self.timers.schedule((s, 'idle'), IDLE_TIMEOUT)
+                            # the read deadline runs from the first byte of a command
+                            if not self.client_data[s]:
+                                self.timers.schedule((s, 'read'), READ_TIMEOUT)
                             self.client_data[s] += data
                             if data.endswith(b'\r\n'):
+                                self.timers.cancel((s, 'read'))
                                 self.handle_client(s)
                         else:
-                            s.close()
-                            self.inputs.remove(s)
-                            del self.client_data[s]
+                            self.close_client(s)
                     except Exception as e:
-                        s.close()
-                        self.inputs.remove(s)
-                        if s in self.client_data:
-                            del self.client_data[s]
+                        self.close_client(s)
 
     def handle_client(self, client_sock):
         """Handle a new client connection."""
@@ -70,10 +148,7 @@ class FTPServer:
             elif command == 'QUIT':
                 response = b'221 Goodbye\r\n'
                 client_sock.sendall(zlib.compress(response))
-                client_sock.close()
-                self.inputs.remove(client_sock)
-                if client_sock in self.client_data:
-                    del self.client_data[client_sock]
+                self.close_client(client_sock)
                 return
             else:
                 response = b'502 Command not implemented\r\n'
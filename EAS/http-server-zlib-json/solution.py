@@ -3,12 +3,19 @@ import unittest
 from unittest import mock
 from unittest.mock import patch, MagicMock
 import sys
+import os
+import signal
 from io import StringIO
 import zlib
 import json
 import select
+import time
+import random
+import threading
+import traceback
+from collections import deque
 
-def get_content(status):
+def render_content(status):
     if status == 404:
         message = '404 Not found'
     elif status == 403:
@@ -24,62 +31,634 @@ def get_content(status):
     })
     return zlib.compress(data.encode('utf-8'))
 
-def create_server(host='localhost', port=8080):
+# compressed body for each status, serialized and compressed only the
+# first time it is asked for
+CONTENT = {}
+
+def get_content(status):
+    content = CONTENT.get(status)
+    if content is None:
+        content = CONTENT[status] = render_content(status)
+    return content
+
+def create_server(host='localhost', port=8080, reuse_port=False):
     """Create a server socket and listen for incoming connections"""
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # every prefork worker listens on its own socket and the kernel
+        # hands each new connection to one of them
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind((host, port))
     server_socket.listen(5)
 
     return server_socket
 
+class ParseError(Exception):
+    """A request that cannot be parsed, status is the response code to send"""
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+class Headers(dict):
+    """Header fields by name, looked up case-insensitively"""
+    def __setitem__(self, name, value):
+        dict.__setitem__(self, name.lower(), value)
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+class Request:
+    """One parsed request: request line, header fields and body"""
+    def __init__(self, method, target, version, headers, head):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.head = head        # header block as received, for logging
+        self.body = b''
+
+    @property
+    def keep_alive(self):
+        """HTTP/1.1 connections stay open unless the client sends Connection: close"""
+        return self.version == 'HTTP/1.1' and 'close' not in self.headers.get('connection', '').lower()
+
+class RequestParser:
+    """
+    Incremental request parser: feed() it the bytes of every recv and take
+    complete requests from next_request(). The search for the end of the
+    header resumes where the previous one stopped, the header is parsed
+    once, and the body is framed by Content-Length or chunked coding.
+    """
+    def __init__(self, max_header=16 * 1024, max_body=1024 * 1024):
+        self.buffer = bytearray()
+        self.scanned = 0        # no header terminator starts before this offset
+        self.request = None     # header parsed, body not complete yet
+        self.chunks = None      # chunked body received so far
+        self.max_header = max_header
+        self.max_body = max_body
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_request(self):
+        """Return the next complete Request, None if more bytes are needed"""
+        if self.request is None:
+            end = self.buffer.find(b'\r\n\r\n', self.scanned)
+            if end < 0:
+                if len(self.buffer) > self.max_header:
+                    raise ParseError(431, 'request header too large')
+                self.scanned = max(0, len(self.buffer) - 3)
+                return None
+            if end > self.max_header:
+                raise ParseError(431, 'request header too large')
+            head = self.buffer[:end].decode('latin-1')
+            del self.buffer[:end + 4]
+            self.scanned = 0
+            self.request = self.parse_head(head)
+
+        if not self.read_body(self.request):
+            return None
+        request, self.request = self.request, None
+        return request
+
+    def parse_head(self, head):
+        lines = head.split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3:
+            raise ParseError(400, 'bad request line')
+        # fill a plain dict with lowercase names, Headers only adds the lookups
+        fields = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep or not name or name != name.strip():
+                raise ParseError(400, 'bad header line')
+            name = name.lower()
+            value = value.strip()
+            if name in fields:
+                # repeated fields are combined into one list
+                fields[name] += ', ' + value
+            else:
+                fields[name] = value
+        return Request(parts[0], parts[1], parts[2], Headers(fields), head)
+
+    def read_body(self, request):
+        """Move the body out of the buffer into request, False while it is incomplete"""
+        if 'chunked' in request.headers.get('transfer-encoding', '').lower():
+            return self.read_chunks(request)
+        length = request.headers.get('content-length')
+        if length is None:
+            return True
+        if not length.isdigit():
+            raise ParseError(400, 'bad content length')
+        length = int(length)
+        if length > self.max_body:
+            raise ParseError(413, 'request body too large')
+        if len(self.buffer) < length:
+            return False
+        request.body = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        return True
+
+    def read_chunks(self, request):
+        if self.chunks is None:
+            self.chunks = bytearray()
+        buf = self.buffer
+        while True:
+            line_end = buf.find(b'\r\n')
+            if line_end < 0:
+                if len(buf) > self.max_header:
+                    raise ParseError(400, 'bad chunk size')
+                return False
+            try:
+                size = int(buf[:line_end].split(b';')[0], 16)
+            except ValueError:
+                size = -1
+            if size < 0:
+                raise ParseError(400, 'bad chunk size')
+
+            if size == 0:
+                # the last chunk, then optional trailer fields up to an empty line
+                end = buf.find(b'\r\n\r\n', line_end)
+                if end < 0:
+                    return False
+                del buf[:end + 4]
+                request.body = bytes(self.chunks)
+                self.chunks = None
+                return True
+
+            if len(self.chunks) + size > self.max_body:
+                raise ParseError(413, 'request body too large')
+            start = line_end + 2
+            if len(buf) < start + size + 2:
+                return False
+            self.chunks += buf[start:start + size]
+            del buf[:start + size + 2]
+
+def parse_request(data):
+    """Parse one complete request, raises ParseError if it is not"""
+    parser = RequestParser()
+    parser.feed(data)
+    request = parser.next_request()
+    if request is None:
+        raise ParseError(400, 'incomplete request')
+    return request
+
 def get_header(data):
     """Extract the request file from the request header"""
-    header, body = data.split('\r\n\r\n')
-    request, host = header.split('\r\n')
-    
-    print(f'request header: [\'{request}\', \'{host}\', \'\', \'\']')
-
-    page = request.split(' ')[1]
-    
-    return page
-
-def serve():
-    """Start the server and process incoming requests"""
-    server_socket = create_server()
+    request = parse_request(data.encode('utf-8'))
+
+    return request.target
+
+class AccessLog:
+    """
+    Access log kept off the request path: log() stores a record, a
+    (time, status, method, target) tuple, in a preallocated ring and
+    returns; a background thread formats the records and writes them in
+    batches to the log file, or to stdout without one. log() never waits:
+    when the ring is full the record is dropped and counted, and the
+    writer reports the count in the log.
+    """
+    def __init__(self, path=None, slots=4096, interval=0.5):
+        # appending, so several workers can share one log file
+        self.file = open(path, 'ab', buffering=0) if path else None
+        self.ring = [None] * slots
+        self.slots = slots
+        self.head = 0       # next record to write, moved by the writer only
+        self.tail = 0       # next free slot, moved by log() only
+        self.dropped = 0
+        self.reported = 0
+        self.interval = interval
+        self.wakeup = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def log(self, method, target, status):
+        tail = self.tail
+        if tail - self.head >= self.slots:
+            self.dropped += 1
+            return
+        self.ring[tail % self.slots] = (time.time(), status, method, target)
+        self.tail = tail + 1
+        # do not wait for the interval when the ring is filling up
+        if tail - self.head == self.slots // 2:
+            self.wakeup.set()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """Write the records logged so far in one batch"""
+        # one producer, one consumer: only log() moves tail and only the
+        # writer thread moves head, so each side reads the other's index
+        # without a lock. A second thread calling log() would need one
+        lines = []
+        ring = self.ring
+        tail = self.tail
+        for i in range(self.head, tail):
+            when, status, method, target = ring[i % self.slots]
+            lines.append('%s.%03d %d %s %s\n' % (time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(when)),
+                                                when % 1 * 1000, status, method, target))
+        # the slots are free once the records are formatted
+        self.head = tail
+
+        dropped = self.dropped
+        if dropped != self.reported:
+            lines.append('access log: %d records dropped\n' % (dropped - self.reported))
+            self.reported = dropped
+        if not lines:
+            return
+        if self.file is None:
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+        else:
+            data = memoryview(''.join(lines).encode('utf-8'))
+            while data:
+                data = data[self.file.write(data):]
+
+    def close(self):
+        """Write what is left and stop the writer thread"""
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        if self.file is not None:
+            self.file.close()
+
+# stop reading from a client once this many response bytes are queued
+# for it, resume once the queue has drained below the low watermark
+HIGH_WATERMARK = 64 * 1024
+LOW_WATERMARK = 16 * 1024
+
+class TimerWheel:
+    """Hashed timer wheel, O(1) schedule and cancel of deadlines keyed by any hashable"""
+    def __init__(self, tick=0.5, span=300):
+        # one lap of the wheel covers span seconds, so a timeout up to span
+        # never shares its slot with a key due a lap later
+        self.tick = tick
+        self.slots = [{} for _ in range(int(-(-span // tick)) + 1)]
+        self.timers = {}
+        self.current = int(time.monotonic() / tick)
+        # no slot before this tick is occupied, next_timeout starts here
+        self.cursor = self.current + 1
+
+    def schedule(self, key, timeout):
+        """(Re)arm the deadline for key, rounded up to the next tick"""
+        self.cancel(key)
+        expiry = max(int(-(-(time.monotonic() + timeout) // self.tick)), self.current + 1)
+        self.slots[expiry % len(self.slots)][key] = expiry
+        self.timers[key] = expiry
+        if expiry > self.current + len(self.slots):
+            # longer than a lap: its slot may come round before the cursor
+            self.cursor = self.current + 1
+        self.cursor = min(self.cursor, expiry)
+
+    def cancel(self, key):
+        expiry = self.timers.pop(key, None)
+        if expiry is not None:
+            del self.slots[expiry % len(self.slots)][key]
+
+    def next_timeout(self):
+        """Seconds until the next occupied slot, None when nothing is scheduled"""
+        if not self.timers:
+            return None
+        size = len(self.slots)
+        for t in range(max(self.cursor, self.current + 1), self.current + size + 1):
+            if self.slots[t % size]:
+                self.cursor = t
+                return max(0, t * self.tick - time.monotonic())
+
+    def expire(self):
+        """Remove and return the keys whose deadline has passed"""
+        now = int(time.monotonic() / self.tick)
+        size = len(self.slots)
+        expired = []
+        for t in range(self.current + 1, min(now, self.current + size) + 1):
+            slot = self.slots[t % size]
+            for key, expiry in list(slot.items()):
+                if expiry <= now:
+                    del slot[key]
+                    del self.timers[key]
+                    expired.append(key)
+        self.current = max(self.current, now)
+        return expired
+
+# close clients that send nothing for IDLE_TIMEOUT seconds, or that read
+# none of their queued response for WRITE_TIMEOUT seconds
+IDLE_TIMEOUT = 60
+WRITE_TIMEOUT = 30
+
+# a connection is closed after MAX_REQUESTS requests; a decompressed
+# request larger than MAX_REQUEST is refused
+MAX_REQUESTS = 100
+MAX_REQUEST = 64 * 1024
+
+class Inbound:
+    """Splits the bytes from one client into its zlib compressed requests"""
+    def __init__(self):
+        self.inflater = zlib.decompressobj()
+        self.parts = []
+        self.size = 0
+        self.requests = 0
+        self.closing = False
+
+    def feed(self, data):
+        """Return the requests completed by data, raises zlib.error or ValueError on bad input"""
+        done = []
+        while data:
+            part = self.inflater.decompress(data, MAX_REQUEST + 1 - self.size)
+            self.parts.append(part)
+            self.size += len(part)
+            if self.size > MAX_REQUEST:
+                raise ValueError('request too large')
+            if not self.inflater.eof:
+                break
+            # a zlib stream ends by itself, anything after it is the next request
+            done.append(b''.join(self.parts))
+            data = self.inflater.unused_data
+            self.inflater = zlib.decompressobj()
+            self.parts = []
+            self.size = 0
+        return done
+
+class Outbound:
+    """Memoryviews waiting to be sent to one client"""
+    def __init__(self):
+        self.queue = deque()
+        self.pending = 0
+
+    def append(self, data):
+        self.queue.append(memoryview(data))
+        self.pending += len(data)
+
+    def flush(self, sock):
+        """Send as much as the socket accepts without blocking"""
+        queue = self.queue
+        try:
+            while queue:
+                view = queue[0]
+                sent = sock.send(view)
+                self.pending -= sent
+                if sent < len(view):
+                    queue[0] = view[sent:]
+                    break
+                queue.popleft()
+        except BlockingIOError:
+            pass
+
+def serve(server_socket=None, max_requests=0, log_path=None, on_retire=None):
+    """
+    Start the server and process incoming requests. After max_requests
+    requests (0 for no limit) the loop closes server_socket and returns
+    once its clients are done, so that a prefork worker can be replaced;
+    on_retire is called when it stops accepting. Requests are logged to
+    the file at log_path, or stdout without one.
+    """
+    if server_socket is None:
+        server_socket = create_server()
+    access_log = AccessLog(log_path)
     input_socket = [server_socket]
+    output_socket = []
+    outbound = {}
+    inbound = {}
+    timers = TimerWheel(span=max(IDLE_TIMEOUT, WRITE_TIMEOUT))
+    served = 0
+
+    def close(sock):
+        sock.close()
+        if sock in input_socket:
+            input_socket.remove(sock)
+        if sock in output_socket:
+            output_socket.remove(sock)
+        outbound.pop(sock, None)
+        inbound.pop(sock, None)
+        timers.cancel((sock, 'idle'))
+        timers.cancel((sock, 'write'))
+
+    def retire():
+        # stop listening, connections still in the backlog are left to the
+        # next worker on the socket; close the kept-alive clients that are
+        # between requests, the others after their next response
+        input_socket.remove(server_socket)
+        server_socket.close()
+        if on_retire is not None:
+            on_retire()
+        for sock, reader in list(inbound.items()):
+            if reader.requests and not reader.parts:
+                reader.closing = True
+                if not outbound[sock].queue:
+                    close(sock)
+                elif sock in input_socket:
+                    input_socket.remove(sock)
 
     try:
-        while True:
-            read_ready, write_ready, exception = select.select(input_socket, [], [])
-            
+        while server_socket in input_socket or inbound:
+            read_ready, write_ready, exception = select.select(input_socket, output_socket, [],
+                                                               timers.next_timeout())
+
+            for sock, kind in timers.expire():
+                close(sock)
+
+            for sock in write_ready:
+                out = outbound.get(sock)
+                if out is None:
+                    continue
+                try:
+                    out.flush(sock)
+                except ConnectionError:
+                    close(sock)
+                    continue
+
+                if not out.queue:
+                    output_socket.remove(sock)
+                    timers.cancel((sock, 'write'))
+                    if inbound[sock].closing:
+                        close(sock)
+                        continue
+                else:
+                    # the client is still reading, push the deadline back
+                    timers.schedule((sock, 'write'), WRITE_TIMEOUT)
+                if out.pending <= LOW_WATERMARK and sock not in input_socket \
+                        and not inbound[sock].closing:
+                    input_socket.append(sock)
+
             for sock in read_ready:
                 if sock == server_socket:
-                    client_socket, client_address = server_socket.accept()
-                    input_socket.append(client_socket)        
-                else:                
-                    data = sock.recv(1024)
-                
+                    try:
+                        client_socket, client_address = server_socket.accept()
+                    except (BlockingIOError, InterruptedError):
+                        # another worker sharing the socket got it first
+                        continue
+                    client_socket.setblocking(False)
+                    input_socket.append(client_socket)
+                    outbound[client_socket] = Outbound()
+                    inbound[client_socket] = Inbound()
+                    timers.schedule((client_socket, 'idle'), IDLE_TIMEOUT)
+                elif sock in outbound:
+                    try:
+                        data = sock.recv(1024)
+                    except BlockingIOError:
+                        continue
+                    except ConnectionError:
+                        data = b''
+
                     if data:
+                        timers.schedule((sock, 'idle'), IDLE_TIMEOUT)
+                        out = outbound[sock]
+                        idle = not out.queue
+                        reader = inbound[sock]
                         try:
-                            data = zlib.decompress(data).decode('utf-8').strip()
-                            page = get_header(data)
-                            
-                            if page == '/index.html':
-                                response = get_content(200)
-                            else:
-                                response = get_content(404)
-                            
-                            sock.send(response)
-                        except:
-                            response = get_content(500)
-                            sock.send(response)
-                    else:         
-                        sock.close()
-                        input_socket.remove(sock)
-               
-    except KeyboardInterrupt:        
-        server_socket.close()     
+                            requests = reader.feed(data)
+                        except (zlib.error, ValueError):
+                            # the stream cannot be resynchronised, answer and close
+                            requests = []
+                            reader.closing = True
+                            out.append(get_content(500))
+
+                        # pipelined requests are answered in the order they came
+                        for request in requests:
+                            reader.requests += 1
+                            served += 1
+                            keep_alive = True
+                            method = target = '-'
+                            try:
+                                request = parse_request(request)
+                                method, target = request.method, request.target
+                                keep_alive = request.keep_alive
+
+                                if request.target == '/index.html':
+                                    status = 200
+                                else:
+                                    status = 404
+                            except:
+                                status = 500
+                            access_log.log(method, target, status)
+                            out.append(get_content(status))
+
+                            if not keep_alive or reader.requests >= MAX_REQUESTS \
+                                    or (max_requests and served >= max_requests):
+                                reader.closing = True
+                                break
+
+                        if idle and out.queue:
+                            try:
+                                out.flush(sock)
+                            except ConnectionError:
+                                close(sock)
+                                continue
+
+                        if reader.closing and not out.queue:
+                            close(sock)
+                            continue
+                        if out.queue and sock not in output_socket:
+                            output_socket.append(sock)
+                            timers.schedule((sock, 'write'), WRITE_TIMEOUT)
+                        # do not read more requests from a client that is
+                        # not reading its responses, or that is done
+                        if out.pending >= HIGH_WATERMARK or reader.closing:
+                            input_socket.remove(sock)
+                    else:
+                        close(sock)
+
+            if max_requests and served >= max_requests and server_socket in input_socket:
+                retire()
+
+    except KeyboardInterrupt:
+        server_socket.close()
+    finally:
+        access_log.close()
+
+def prefork(workers, max_requests=0, log_path=None):
+    """
+    Serve with several processes: fork workers that each run serve(), and
+    fork a new worker on the same socket as soon as one stops accepting
+    after max_requests requests or dies, until interrupted. Each worker
+    gets up to a quarter more requests than max_requests so that they are
+    not all replaced at once.
+    """
+    if hasattr(socket, 'SO_REUSEPORT'):
+        # one listening socket per worker slot: the kernel hands a new
+        # connection to one of them and wakes only that worker. The master
+        # keeps them open, so connections queued on the socket of a worker
+        # that retires wait for its replacement instead of being reset
+        listeners = [create_server(reuse_port=True) for _ in range(workers)]
+    else:
+        # one shared socket, every worker wakes up and one gets the
+        # connection, the others see BlockingIOError
+        listeners = [create_server()] * workers
+    for server_socket in listeners:
+        server_socket.setblocking(False)
+
+    # a worker that stops accepting writes its slot here, while it may
+    # still be finishing its clients
+    retired_r, retired_w = os.pipe()
+    children = {}   # pid -> slot of every worker still running
+    accepting = {}  # slot -> pid of the worker accepting on its socket
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    # kill and Ctrl-C stop the master and the workers, which inherit this
+    signal.signal(signal.SIGTERM, stop)
+
+    def spawn(slot):
+        limit = max_requests and max_requests + random.randint(0, max_requests // 4)
+        pid = os.fork()
+        if pid == 0:
+            os.close(retired_r)
+            status = 1
+            try:
+                serve(listeners[slot], limit, log_path,
+                      lambda: os.write(retired_w, slot.to_bytes(2, 'big')))
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        children[pid] = slot
+        accepting[slot] = pid
+
+    try:
+        for slot in range(workers):
+            spawn(slot)
+        while True:
+            ready, _, _ = select.select([retired_r], [], [], 1.0)
+            if ready:
+                # writes of two bytes to a pipe are never split
+                data = os.read(retired_r, 512)
+                for i in range(0, len(data), 2):
+                    spawn(int.from_bytes(data[i:i + 2], 'big'))
+            # reap the workers that exited; one that died while still
+            # accepting has no replacement yet
+            while children:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                slot = children.pop(pid)
+                if accepting.get(slot) == pid:
+                    # do not fork a worker that fails on start in a tight loop
+                    time.sleep(1)
+                    spawn(slot)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            os.waitpid(pid, 0)
+        for server_socket in listeners:
+            server_socket.close()
 
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
@@ -211,8 +790,13 @@ class TestHttpServer(unittest.TestCase):
         assert_true(mock_server_socket.close.called, 'close')
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2 and sys.argv[1] == 'run':
-        serve()
+    # python solution.py run [workers [max_requests [access_log]]]
+    if len(sys.argv) >= 2 and sys.argv[1] == 'run':
+        if len(sys.argv) > 2:
+            prefork(int(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else 0,
+                    sys.argv[4] if len(sys.argv) > 4 else None)
+        else:
+            serve()
 
     # run unit test to test locally
     # or for domjudge
@@ -5,10 +5,70 @@ from io import StringIO
 import os
 import sys
 import select
+import time
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 BUFFER_SIZE = 1024
 
+# close clients that have not sent anything for this many seconds
+IDLE_TIMEOUT = 300
+# give up on an upload when the client stops sending for this long
+READ_TIMEOUT = 30
+
+class TimerWheel:
+    """Hashed timer wheel, O(1) schedule and cancel of deadlines keyed by any hashable"""
+    def __init__(self, tick=0.5, span=300):
+        # one lap of the wheel covers span seconds, so a timeout up to span
+        # never shares its slot with a key due a lap later
+        self.tick = tick
+        self.slots = [{} for _ in range(int(-(-span // tick)) + 1)]
+        self.timers = {}
+        self.current = int(time.monotonic() / tick)
+        # no slot before this tick is occupied, next_timeout starts here
+        self.cursor = self.current + 1
+
+    def schedule(self, key, timeout):
+        """(Re)arm the deadline for key, rounded up to the next tick"""
+        self.cancel(key)
+        expiry = max(int(-(-(time.monotonic() + timeout) // self.tick)), self.current + 1)
+        self.slots[expiry % len(self.slots)][key] = expiry
+        self.timers[key] = expiry
+        if expiry > self.current + len(self.slots):
+            # longer than a lap: its slot may come round before the cursor
+            self.cursor = self.current + 1
+        self.cursor = min(self.cursor, expiry)
+
+    def cancel(self, key):
+        expiry = self.timers.pop(key, None)
+        if expiry is not None:
+            del self.slots[expiry % len(self.slots)][key]
+
+    def next_timeout(self):
+        """Seconds until the next occupied slot, None when nothing is scheduled"""
+        if not self.timers:
+            return None
+        size = len(self.slots)
+        for t in range(max(self.cursor, self.current + 1), self.current + size + 1):
+            if self.slots[t % size]:
+                self.cursor = t
+                return max(0, t * self.tick - time.monotonic())
+
+    def expire(self):
+        """Remove and return the keys whose deadline has passed"""
+        now = int(time.monotonic() / self.tick)
+        size = len(self.slots)
+        expired = []
+        for t in range(self.current + 1, min(now, self.current + size) + 1):
+            slot = self.slots[t % size]
+            for key, expiry in list(slot.items()):
+                if expiry <= now:
+                    del slot[key]
+                    del self.timers[key]
+                    expired.append(key)
+        self.current = max(self.current, now)
+        return expired
+
+
 class Server:
     def __init__(self, host="localhost", port=65432):
         # define host and port
@@ -30,6 +90,16 @@ class Server:
         # list for select
         # the first element is the server socket
         self.input_socket = [self.server_socket]
+
+        # idle deadlines of the connected clients
+        self.timers = TimerWheel(span=max(IDLE_TIMEOUT, READ_TIMEOUT))
+
+    def close_client(self, sock):
+        # close socket, remove it from list for select and drop its deadline
+        sock.close()
+        if sock in self.input_socket:
+            self.input_socket.remove(sock)
+        self.timers.cancel(sock)
     
     def parse_header(self, header_content):
         # Parse the header and return the file name, size, and content
@@ -52,6 +122,10 @@ class Server:
             # check content length
             # write to file if content length > 0
             if content_length > 0:
+                # the first chunk arrives decoded together with the header
+                if isinstance(first_chunk, str):
+                    first_chunk = first_chunk.encode()
+
                 # initiate total received data with first content length
                 total_received = len(first_chunk)
 
@@ -60,9 +134,16 @@ class Server:
 
             # Receive and save the file
             # while total received data is less than file size
+            # a stalled client must not hold the server forever,
+            # wait at most READ_TIMEOUT for each chunk
+            sock.settimeout(READ_TIMEOUT)
             while total_received < file_size:
                 # receive data
-                chunk = sock.recv(min(BUFFER_SIZE, file_size - total_received))
+                try:
+                    chunk = sock.recv(min(BUFFER_SIZE, file_size - total_received))
+                except socket.timeout:
+                    print(f"[-] Upload of {file_path} timed out")
+                    break
                 if not chunk:
                     break
 
@@ -71,18 +152,33 @@ class Server:
 
                 # total received is equal to total received plus chunk length
                 total_received += len(chunk)
-            
-            print(f"[+] File {file_path} received successfully!")
 
-            # Send confirmation to the client
-            sock.sendall(b'File received successfully')
+        if total_received < file_size:
+            # timed out or the client went away: drop the partial file and
+            # the connection, the rest of the upload must not be read as a
+            # command
+            print(f"[-] Upload of {file_path} incomplete, {total_received} of {file_size} bytes")
+            os.remove(file_path)
+            self.close_client(sock)
+            return
+
+        sock.settimeout(None)
+        print(f"[+] File {file_path} received successfully!")
+
+        # Send confirmation to the client
+        sock.sendall(b'File received successfully')
     
     def start(self):
         print(f"[+] Listening from {self.host}:{self.port}")
         try:
             while True:
-                # use select technique
-                read_ready, _, _ = select.select(self.input_socket, [], [])
+                # use select technique, waking up for the next deadline
+                read_ready, _, _ = select.select(self.input_socket, [], [], self.timers.next_timeout())
+
+                # close the clients that have been idle for too long
+                for sock in self.timers.expire():
+                    print(f"[-] Closing idle client {sock}")
+                    self.close_client(sock)
                 
                 for sock in read_ready:
                     # if socket ready is the server socket
@@ -93,17 +189,20 @@ class Server:
 
                         # append client socket to list for select
                         self.input_socket.append(client_socket)
-                    else:
+                        self.timers.schedule(client_socket, IDLE_TIMEOUT)
+                    elif sock.fileno() != -1:
                         try:
                             # Receive command and filename from client
                             data = sock.recv(BUFFER_SIZE).decode()
                         except ConnectionResetError:
-                            # close socket
-                            sock.close()
+                            data = ''
+
+                        if not data:
+                            # client is gone, close socket
+                            self.close_client(sock)
+                            continue
 
-                            # remove socket from list for select
-                            self.input_socket.remove(sock)
-                            break
+                        self.timers.schedule(sock, IDLE_TIMEOUT)
 
                         # get command and filename, use split string
                         command, filename = data.split(' ', 1)
@@ -5,11 +5,69 @@ from io import StringIO
 import os
 import sys
 import select
+import time
 
 # define host and port
 HOST = '127.0.0.1'
 PORT = 65432
 
+# close clients that have not sent anything for this many seconds
+IDLE_TIMEOUT = 300
+
+class TimerWheel:
+    """Hashed timer wheel, O(1) schedule and cancel of deadlines keyed by any hashable"""
+    def __init__(self, tick=0.5, span=300):
+        # one lap of the wheel covers span seconds, so a timeout up to span
+        # never shares its slot with a key due a lap later
+        self.tick = tick
+        self.slots = [{} for _ in range(int(-(-span // tick)) + 1)]
+        self.timers = {}
+        self.current = int(time.monotonic() / tick)
+        # no slot before this tick is occupied, next_timeout starts here
+        self.cursor = self.current + 1
+
+    def schedule(self, key, timeout):
+        """(Re)arm the deadline for key, rounded up to the next tick"""
+        self.cancel(key)
+        expiry = max(int(-(-(time.monotonic() + timeout) // self.tick)), self.current + 1)
+        self.slots[expiry % len(self.slots)][key] = expiry
+        self.timers[key] = expiry
+        if expiry > self.current + len(self.slots):
+            # longer than a lap: its slot may come round before the cursor
+            self.cursor = self.current + 1
+        self.cursor = min(self.cursor, expiry)
+
+    def cancel(self, key):
+        expiry = self.timers.pop(key, None)
+        if expiry is not None:
+            del self.slots[expiry % len(self.slots)][key]
+
+    def next_timeout(self):
+        """Seconds until the next occupied slot, None when nothing is scheduled"""
+        if not self.timers:
+            return None
+        size = len(self.slots)
+        for t in range(max(self.cursor, self.current + 1), self.current + size + 1):
+            if self.slots[t % size]:
+                self.cursor = t
+                return max(0, t * self.tick - time.monotonic())
+
+    def expire(self):
+        """Remove and return the keys whose deadline has passed"""
+        now = int(time.monotonic() / self.tick)
+        size = len(self.slots)
+        expired = []
+        for t in range(self.current + 1, min(now, self.current + size) + 1):
+            slot = self.slots[t % size]
+            for key, expiry in list(slot.items()):
+                if expiry <= now:
+                    del slot[key]
+                    del self.timers[key]
+                    expired.append(key)
+        self.current = max(self.current, now)
+        return expired
+
+
 def receive_message(client_socket):
     try:
         # receive message
@@ -48,12 +106,20 @@ def start_server():
     # initiate socket list, first element is the server socket
     sockets_list = [server_socket]
     clients = {}
+    timers = TimerWheel(span=IDLE_TIMEOUT)
 
     print(f'Listening for connections on {HOST}:{PORT}...')
 
     while True:
-        # use select to serve many clients
-        read_sockets, _, _ = select.select(sockets_list, [], [])
+        # use select to serve many clients, waking up for the next deadline
+        read_sockets, _, _ = select.select(sockets_list, [], [], timers.next_timeout())
+
+        # close the clients that have been idle for too long
+        for sock in timers.expire():
+            print('Idle connection from: {}'.format(clients[sock].decode('utf-8')))
+            sockets_list.remove(sock)
+            del clients[sock]
+            sock.close()
 
         # check for each read-ready socket
         for sock in read_sockets:
@@ -74,10 +140,11 @@ def start_server():
                 # add client socket and user to the clients dictionary
                 # key: client_socket, value: user
                 clients[client_socket] = user
+                timers.schedule(client_socket, IDLE_TIMEOUT)
                 print('Accepted new connection from {}:{}, nickname: {}'.format(*client_address, user))    # nickname == user
-            else:
+            elif sock in clients:
                 # receive message from read-ready socket
-                message = receive_message(sock).decode()
+                message = receive_message(sock)
 
                 # check if message is False
                 if message is False:
@@ -88,8 +155,13 @@ def start_server():
 
                     # delete read ready socket from clients dictionary
                     del clients[sock]
+                    timers.cancel(sock)
+                    sock.close()
                     continue
 
+                message = message.decode()
+                timers.schedule(sock, IDLE_TIMEOUT)
+
                 # get user data from the clients dictionary based on the socket 
                 user = clients[sock]
 
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# compare bulk echo throughput of server-select.py with and without --splice
+#
+#   python bench-splice.py -c 4 -d 5
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+server_address = ('127.0.0.1', 5001)
+
+
+def stream(deadline, chunk, totals, index):
+    # send as fast as possible until the deadline and count the echo
+    sock = socket.create_connection(server_address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    payload = memoryview(bytearray(chunk))
+
+    def send():
+        while time.perf_counter() < deadline:
+            sock.sendall(payload)
+        sock.shutdown(socket.SHUT_WR)
+
+    sender = threading.Thread(target=send)
+    sender.start()
+
+    buf = memoryview(bytearray(chunk))
+    received = 0
+    while True:
+        n = sock.recv_into(buf)
+        if not n:
+            break
+        received += n
+    sender.join()
+    sock.close()
+    totals[index] = received
+
+
+def run(mode_args, connections, duration, chunk):
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, 'server-select.py')] + mode_args)
+    try:
+        # wait until the server is listening
+        for _ in range(50):
+            try:
+                socket.create_connection(server_address).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+
+        totals = [0] * connections
+        start = time.perf_counter()
+        threads = [threading.Thread(target=stream, args=(start + duration, chunk, totals, i))
+                   for i in range(connections)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'bytes': sum(totals),
+        'seconds': round(elapsed, 3),
+        'gb_per_s': round(sum(totals) / elapsed / 1e9, 3),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='splice vs recv_into echo benchmark')
+    parser.add_argument('-c', '--connections', type=int, default=4)
+    parser.add_argument('-d', '--duration', type=float, default=5, help='seconds per mode')
+    parser.add_argument('--chunk', type=int, default=256 * 1024, help='bytes per client send')
+    args = parser.parse_args()
+
+    results = {
+        'connections': args.connections,
+        'chunk': args.chunk,
+        'recv_into': run([], args.connections, args.duration, args.chunk),
+        'splice': run(['--splice'], args.connections, args.duration, args.chunk),
+    }
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# load generator for the echo servers, prints the results as JSON
+#
+#   python client-load.py --port 5001 -c 100 -s 64 -d 10          (closed loop)
+#   python client-load.py --port 5000 -c 100 -s 64 --rate 20000   (fixed rate)
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+
+
+class Histogram:
+    """
+    Log-linear latency histogram in the style of HdrHistogram: values
+    below 128 are exact, above that each power of two is split into 64
+    buckets, so any recorded value is within 1.6% of the true one.
+    """
+
+    SUB_BUCKETS = 64
+
+    def __init__(self):
+        self.counts = [0] * (64 * self.SUB_BUCKETS)
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def index(self, value):
+        if value < 2 * self.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - 7
+        return self.SUB_BUCKETS * shift + (value >> shift)
+
+    def value_at(self, index):
+        # lowest value that falls in the bucket at index
+        if index < 2 * self.SUB_BUCKETS:
+            return index
+        shift = index // self.SUB_BUCKETS - 1
+        return (index - self.SUB_BUCKETS * shift) << shift
+
+    def record(self, value):
+        self.counts[self.index(value)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.total:
+            return 0
+        rank = max(1, round(self.total * p / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.value_at(index), self.max)
+        return self.max
+
+
+async def closed_loop(reader, writer, message, deadline, histogram, timeout):
+    # send one message, wait for the whole echo, repeat
+    size = len(message)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter_ns()
+        writer.write(message)
+        await asyncio.wait_for(reader.readexactly(size), timeout)
+        histogram.record((time.perf_counter_ns() - start) // 1000)
+
+
+async def fixed_rate(reader, writer, message, deadline, histogram, interval, timeout):
+    # send on a fixed schedule regardless of how fast replies come back;
+    # latency is measured from the scheduled send time so a stalled server
+    # is not hidden by the client backing off (coordinated omission)
+    size = len(message)
+    scheduled = deque()
+    finished = False
+
+    async def receive():
+        while True:
+            # only time out while an echo is outstanding
+            await asyncio.wait_for(reader.readexactly(size), timeout if scheduled else None)
+            histogram.record((time.perf_counter_ns() - scheduled.popleft()) // 1000)
+            if finished and not scheduled:
+                return
+
+    receiver = asyncio.create_task(receive())
+    try:
+        next_send = time.perf_counter()
+        # stop early if the receiver failed, its error is raised below
+        while next_send < deadline and not receiver.done():
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            scheduled.append(int(next_send * 1e9))
+            writer.write(message)
+            # a server that stops reading fills the socket buffer; wait for
+            # room instead of queueing the rest of the run in memory
+            await asyncio.wait_for(writer.drain(), timeout)
+            next_send += interval
+        finished = True
+        if scheduled or receiver.done():
+            await asyncio.wait_for(receiver, timeout)
+        else:
+            receiver.cancel()
+            try:
+                await receiver
+            except asyncio.CancelledError:
+                pass
+    finally:
+        receiver.cancel()
+
+
+async def connection(args, message, deadline, histogram, errors):
+    try:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+    except OSError:
+        errors['connect'] += 1
+        return
+    try:
+        if args.rate:
+            interval = args.connections / args.rate
+            await fixed_rate(reader, writer, message, deadline, histogram, interval, args.timeout)
+        else:
+            await closed_loop(reader, writer, message, deadline, histogram, args.timeout)
+    # TimeoutError is an OSError from Python 3.11 on, check it first
+    except asyncio.TimeoutError:
+        errors['timeout'] += 1
+    except (OSError, asyncio.IncompleteReadError):
+        errors['io'] += 1
+    finally:
+        writer.close()
+
+
+async def run(args):
+    # perf_counter_ns and perf_counter share a clock
+    message = b'x' * args.size
+    histogram = Histogram()
+    errors = {'connect': 0, 'io': 0, 'timeout': 0}
+
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*[connection(args, message, deadline, histogram, errors)
+                           for _ in range(args.connections)])
+    elapsed = time.perf_counter() - start
+
+    return {
+        'host': args.host,
+        'port': args.port,
+        'mode': 'rate' if args.rate else 'closed-loop',
+        'connections': args.connections,
+        'size': args.size,
+        'duration': round(elapsed, 3),
+        'requests': histogram.total,
+        'rps': round(histogram.total / elapsed, 1),
+        'throughput_mbps': round(histogram.total * args.size * 8 / elapsed / 1e6, 2),
+        'latency_us': {
+            'mean': round(histogram.sum / histogram.total, 1) if histogram.total else 0,
+            'p50': histogram.percentile(50),
+            'p90': histogram.percentile(90),
+            'p99': histogram.percentile(99),
+            'p999': histogram.percentile(99.9),
+            'max': histogram.max,
+        },
+        'errors': errors,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='echo server load generator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('-c', '--connections', type=int, default=10)
+    parser.add_argument('-s', '--size', type=int, default=64, help='message size in bytes')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='total messages per second, closed loop if not given')
+    parser.add_argument('--timeout', type=float, default=5,
+                        help='seconds to wait for an echo before counting a timeout')
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
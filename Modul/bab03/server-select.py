@@ -1,34 +1,558 @@
 import socket
-import select
+import selectors
+import resource
+import argparse
+import fcntl
+import mmap
+import os
+import signal
+import time
 import sys
+from collections import deque
 
 server_address = ('127.0.0.1', 5001)
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-server_socket.bind(server_address)
-server_socket.listen(5)
 
-input_socket = [server_socket]
+# stop reading from a client once this many bytes are waiting to be sent
+# to it, and resume once the backlog has drained below the low watermark
+HIGH_WATERMARK = 256 * 1024
+LOW_WATERMARK = 64 * 1024
 
-try:
+# size of each receive buffer, see --buffer-size
+BUFFER_SIZE = 64 * 1024
+
+# plain-text metrics are served on this port, one port per worker
+ADMIN_PORT = 9101
+
+# --splice: move data socket -> pipe -> socket inside the kernel (Linux)
+SPLICE_PIPE_SIZE = 1024 * 1024
+use_splice = False
+
+
+class BufferPool:
+    # preallocated receive buffers; a buffer is taken for every recv_into
+    # and given back once its bytes have been sent, so in the steady state
+    # the echo loop reuses the same few buffers instead of allocating
+    def __init__(self, size, keep=1024):
+        self.size = size
+        self.keep = keep
+        self.free = []
+
+    def get(self):
+        if self.free:
+            return self.free.pop()
+        return memoryview(bytearray(self.size))
+
+    def put(self, buf):
+        if len(self.free) < self.keep:
+            self.free.append(buf)
+
+
+pool = BufferPool(BUFFER_SIZE)
+
+
+class Stats:
+    # process-wide counters; only integer increments on the hot path,
+    # the text is rendered when the admin port is scraped
+    READY_BUCKETS = (1, 4, 16, 64, 256, 1024, 4096)
+
+    def __init__(self):
+        self.accepted = 0
+        self.closed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages = 0
+        self.loops = 0
+        self.handler_ns = 0
+        self.ready_events = 0
+        # ready-set size histogram, bucket i counts sizes <= 4**i
+        self.ready_sizes = [0] * (len(self.READY_BUCKETS) + 1)
+
+    def observe_ready(self, n):
+        self.loops += 1
+        self.ready_events += n
+        self.ready_sizes[min((max(n, 1) - 1).bit_length() + 1 >> 1, len(self.READY_BUCKETS))] += 1
+
+
+stats = Stats()
+
+
+class Connection:
+    # per-connection state, stored as the selector key data
+    __slots__ = ('sock', 'address', 'outbound', 'pending', 'reading',
+                 'closing', 'events', 'high', 'low', 'pipe',
+                 'bytes_in', 'bytes_out', 'messages', 'admin')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.outbound = deque()     # (memoryview, pool buffer or None) to send
+        self.pending = 0            # bytes in outbound
+        self.reading = True
+        self.closing = False
+        self.events = selectors.EVENT_READ
+        self.high = HIGH_WATERMARK
+        self.low = LOW_WATERMARK
+        self.pipe = None            # (read fd, write fd, size) in splice mode
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages = 0
+        self.admin = False          # a metrics scrape, not an echo client
+
+
+def raise_fd_limit():
+    # allow as many open sockets as the hard limit permits
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def create_server(address=server_address, reuse_port=False):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # every worker binds its own socket, the kernel spreads new
+        # connections between them
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind(address)
+    server_socket.listen(socket.SOMAXCONN)
+    server_socket.setblocking(False)
+    return server_socket
+
+
+def accept(selector, server_socket):
+    # drain the accept queue, a burst of clients needs only one wakeup
     while True:
-        read_ready, write_ready, exception = select.select(input_socket, [], [])
-        
-        for sock in read_ready:
-            if sock == server_socket:
-                client_socket, client_address = server_socket.accept()
-                input_socket.append(client_socket)        
-            
-            else:            	
-                data = sock.recv(1024)
-                print(sock.getpeername(), data)
-            
-                if data:
-                    sock.send(data)
-                else:                    
-                    sock.close()
-                    input_socket.remove(sock)
-
-except KeyboardInterrupt:        
-    server_socket.close()
-    sys.exit(0)
+        try:
+            client_socket, client_address = server_socket.accept()
+        except BlockingIOError:
+            return
+        client_socket.setblocking(False)
+        conn = Connection(client_socket, client_address)
+        if use_splice:
+            open_pipe(conn)
+        selector.register(client_socket, conn.events, conn)
+        stats.accepted += 1
+
+
+def close(selector, conn):
+    selector.unregister(conn.sock)
+    conn.sock.close()
+    if not conn.admin:
+        stats.closed += 1
+    for view, buf in conn.outbound:
+        if buf is not None:
+            pool.put(buf)
+    conn.outbound.clear()
+    if conn.pipe is not None:
+        os.close(conn.pipe[0])
+        os.close(conn.pipe[1])
+        conn.pipe = None
+
+
+def update_events(selector, conn):
+    # apply the watermarks, then ask for write readiness only while
+    # there is something queued
+    if conn.reading and conn.pending >= conn.high:
+        conn.reading = False
+    elif not conn.reading and conn.pending <= conn.low:
+        conn.reading = True
+
+    events = 0
+    if conn.reading and not conn.closing:
+        events |= selectors.EVENT_READ
+    if conn.pending:
+        events |= selectors.EVENT_WRITE
+
+    if events != conn.events:
+        conn.events = events
+        selector.modify(conn.sock, events, conn)
+
+
+def flush(selector, conn):
+    # send as much of the outbound queue as the socket accepts now
+    outbound = conn.outbound
+    try:
+        while outbound:
+            view, buf = outbound[0]
+            sent = conn.sock.send(view)
+            conn.pending -= sent
+            conn.bytes_out += sent
+            stats.bytes_out += sent
+            if sent < len(view):
+                outbound[0] = (view[sent:], buf)
+                break
+            outbound.popleft()
+            if buf is not None:
+                pool.put(buf)
+    except BlockingIOError:
+        pass
+    except ConnectionError:
+        close(selector, conn)
+        return
+
+    if conn.closing and not outbound:
+        close(selector, conn)
+    else:
+        update_events(selector, conn)
+
+
+def write(selector, conn, data, buf=None):
+    # buf is the pool buffer data points into, returned once it is sent
+    conn.outbound.append((memoryview(data), buf))
+    conn.pending += len(data)
+    # nothing was queued before, try to send straight away
+    if len(conn.outbound) == 1:
+        flush(selector, conn)
+    else:
+        update_events(selector, conn)
+
+
+def queue(selector, conn, buf, start, end):
+    # keep the unsent part of a receive buffer for later; a small tail is
+    # copied out so the pool buffer can be reused at once, otherwise a slow
+    # reader sending tiny messages would pin a whole buffer per message
+    if end - start < pool.size // 4:
+        conn.outbound.append((memoryview(bytes(buf[start:end])), None))
+        pool.put(buf)
+    else:
+        conn.outbound.append((buf[start:end], buf))
+    conn.pending += end - start
+    update_events(selector, conn)
+
+
+def echo(selector, conn):
+    # returns the number of bytes echoed
+    buf = pool.get()
+    try:
+        n = conn.sock.recv_into(buf)
+    except BlockingIOError:
+        pool.put(buf)
+        return 0
+    except ConnectionError:
+        pool.put(buf)
+        close(selector, conn)
+        return 0
+
+    if n and not conn.outbound:
+        # nothing queued: send straight from the buffer and only queue
+        # what the socket did not take
+        try:
+            sent = conn.sock.send(buf[:n])
+        except BlockingIOError:
+            sent = 0
+        except ConnectionError:
+            pool.put(buf)
+            close(selector, conn)
+            return 0
+        conn.bytes_out += sent
+        stats.bytes_out += sent
+        if sent < n:
+            queue(selector, conn, buf, sent, n)
+        else:
+            pool.put(buf)
+        return n
+    elif n:
+        queue(selector, conn, buf, 0, n)
+        return n
+
+    pool.put(buf)
+    if conn.outbound:
+        # peer finished sending, close once its echo has been flushed
+        conn.closing = True
+        update_events(selector, conn)
+    else:
+        close(selector, conn)
+    return 0
+
+
+def open_pipe(conn):
+    # the pipe is this connection's buffer in splice mode; reading pauses
+    # while it is full, the same way the watermarks work for the queue
+    r, w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+    try:
+        size = fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+    except OSError:
+        size = fcntl.fcntl(w, fcntl.F_GETPIPE_SZ)
+    conn.pipe = (r, w, size)
+    conn.high = size
+    conn.low = size // 4
+
+
+def splice_flush(selector, conn):
+    # move what is in the pipe back out to the socket
+    r, w, size = conn.pipe
+    try:
+        while conn.pending:
+            sent = os.splice(r, conn.sock.fileno(), conn.pending,
+                             flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            conn.pending -= sent
+            conn.bytes_out += sent
+            stats.bytes_out += sent
+    except BlockingIOError:
+        pass
+    except ConnectionError:
+        close(selector, conn)
+        return
+
+    if conn.closing and not conn.pending:
+        close(selector, conn)
+    else:
+        update_events(selector, conn)
+
+
+def splice_echo(selector, conn):
+    # same as echo() but the bytes never leave the kernel
+    r, w, size = conn.pipe
+    try:
+        n = os.splice(conn.sock.fileno(), w, size - conn.pending,
+                      flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+    except BlockingIOError:
+        return 0
+    except ConnectionError:
+        close(selector, conn)
+        return 0
+
+    if n:
+        conn.pending += n
+        splice_flush(selector, conn)
+    elif conn.pending:
+        conn.closing = True
+        update_events(selector, conn)
+    else:
+        close(selector, conn)
+    return n
+
+
+def render_metrics(selector):
+    # Prometheus text exposition format
+    lines = [
+        '# TYPE echo_connections_accepted_total counter',
+        'echo_connections_accepted_total %d' % stats.accepted,
+        '# TYPE echo_connections_closed_total counter',
+        'echo_connections_closed_total %d' % stats.closed,
+        '# TYPE echo_connections_open gauge',
+        'echo_connections_open %d' % (stats.accepted - stats.closed),
+        '# TYPE echo_received_bytes_total counter',
+        'echo_received_bytes_total %d' % stats.bytes_in,
+        '# TYPE echo_sent_bytes_total counter',
+        'echo_sent_bytes_total %d' % stats.bytes_out,
+        '# TYPE echo_messages_total counter',
+        'echo_messages_total %d' % stats.messages,
+        '# TYPE echo_loop_iterations_total counter',
+        'echo_loop_iterations_total %d' % stats.loops,
+        '# TYPE echo_handler_seconds_total counter',
+        'echo_handler_seconds_total %.6f' % (stats.handler_ns / 1e9),
+        '# TYPE echo_ready_set_size histogram',
+    ]
+    cumulative = 0
+    for bound, count in zip(stats.READY_BUCKETS + ('+Inf',), stats.ready_sizes):
+        cumulative += count
+        lines.append('echo_ready_set_size_bucket{le="%s"} %d' % (bound, cumulative))
+    lines.append('echo_ready_set_size_sum %d' % stats.ready_events)
+    lines.append('echo_ready_set_size_count %d' % stats.loops)
+
+    per_connection = (
+        ('echo_connection_received_bytes', 'bytes_in'),
+        ('echo_connection_sent_bytes', 'bytes_out'),
+        ('echo_connection_messages', 'messages'),
+        ('echo_connection_pending_bytes', 'pending'),
+    )
+    conns = [key.data for key in selector.get_map().values()
+             if isinstance(key.data, Connection) and not key.data.admin]
+    for name, attr in per_connection:
+        lines.append('# TYPE %s gauge' % name)
+        for conn in conns:
+            lines.append('%s{peer="%s:%d"} %d' % ((name,) + conn.address + (getattr(conn, attr),)))
+
+    body = ('\n'.join(lines) + '\n').encode()
+    return (b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+            b'Content-Length: %d\r\n\r\n' % len(body)) + body
+
+
+def accept_admin(selector, admin_socket):
+    while True:
+        try:
+            client_socket, client_address = admin_socket.accept()
+        except BlockingIOError:
+            return
+        client_socket.setblocking(False)
+        conn = Connection(client_socket, client_address)
+        conn.admin = True
+        selector.register(client_socket, conn.events, conn)
+
+
+def scrape(selector, conn):
+    # any request gets the metrics, sent through the normal non-blocking
+    # write path and closed once flushed
+    try:
+        conn.sock.recv(4096)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        close(selector, conn)
+        return
+    conn.closing = True
+    write(selector, conn, render_metrics(selector))
+
+
+def serve(server_socket, counters=None, admin_socket=None):
+    # counters, if given, is a [messages, bytes] view into memory shared
+    # with the supervisor
+    # epoll on Linux, kqueue on BSD; register/unregister are O(1)
+    # and there is no FD_SETSIZE limit as with select()
+    selector = selectors.DefaultSelector()
+    selector.register(server_socket, selectors.EVENT_READ, None)
+    if admin_socket is not None:
+        selector.register(admin_socket, selectors.EVENT_READ, 'admin')
+
+    try:
+        while True:
+            events = selector.select()
+            start = time.perf_counter_ns()
+            stats.observe_ready(len(events))
+
+            for key, mask in events:
+                conn = key.data
+                if conn is None:
+                    accept(selector, server_socket)
+                    continue
+                if conn == 'admin':
+                    accept_admin(selector, admin_socket)
+                    continue
+
+                n = 0
+                if conn.admin:
+                    if mask & selectors.EVENT_WRITE:
+                        flush(selector, conn)
+                    elif mask & selectors.EVENT_READ:
+                        scrape(selector, conn)
+                elif conn.pipe is not None:
+                    if mask & selectors.EVENT_WRITE:
+                        splice_flush(selector, conn)
+                    if mask & selectors.EVENT_READ and conn.pipe is not None:
+                        n = splice_echo(selector, conn)
+                else:
+                    if mask & selectors.EVENT_WRITE:
+                        flush(selector, conn)
+                    if mask & selectors.EVENT_READ and conn.sock.fileno() != -1:
+                        n = echo(selector, conn)
+
+                if n:
+                    conn.bytes_in += n
+                    conn.messages += 1
+                    stats.bytes_in += n
+                    stats.messages += 1
+                    if counters is not None:
+                        counters[0] += 1
+                        counters[1] += n
+
+            stats.handler_ns += time.perf_counter_ns() - start
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+
+def run_worker(counters, admin_port):
+    # runs in the forked child, never returns
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    status = 0
+    try:
+        admin_socket = None
+        if admin_port:
+            admin_socket = create_server((server_address[0], admin_port))
+        serve(create_server(reuse_port=True), counters, admin_socket)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print('worker', os.getpid(), 'crashed:', e)
+        status = 1
+    os._exit(status)
+
+
+def supervise(workers, interval, admin_port):
+    # fork the workers, restart any that die and print the aggregate
+    # echo throughput every interval seconds; worker i serves its
+    # metrics on admin_port + i
+    shared = mmap.mmap(-1, workers * 2 * 8)
+    counters = memoryview(shared).cast('Q')
+    pids = {}
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(counters[slot * 2:slot * 2 + 2], admin_port and admin_port + slot)
+        pids[pid] = slot
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    for slot in range(workers):
+        spawn(slot)
+    signal.signal(signal.SIGTERM, stop)
+    print('Started', workers, 'workers on', server_address)
+
+    last_time = time.monotonic()
+    last_messages = last_bytes = 0
+    try:
+        while True:
+            time.sleep(0.1)
+            while True:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                slot = pids.pop(pid)
+                print('worker', pid, 'exited with status', status, 'restarting')
+                spawn(slot)
+
+            now = time.monotonic()
+            if now - last_time >= interval:
+                messages = sum(counters[0::2])
+                total_bytes = sum(counters[1::2])
+                elapsed = now - last_time
+                print('{:.0f} msg/s {:.2f} MB/s'.format(
+                    (messages - last_messages) / elapsed,
+                    (total_bytes - last_bytes) / elapsed / 1e6))
+                last_time, last_messages, last_bytes = now, messages, total_bytes
+    except KeyboardInterrupt:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='selectors based echo server')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='fork this many SO_REUSEPORT worker processes')
+    parser.add_argument('--report', type=float, default=5,
+                        help='seconds between throughput reports in worker mode')
+    parser.add_argument('--buffer-size', type=int, default=BUFFER_SIZE,
+                        help='bytes read from a client per recv_into')
+    parser.add_argument('--splice', action='store_true',
+                        help='echo with os.splice through a pipe (Linux only)')
+    parser.add_argument('--admin-port', type=int, default=ADMIN_PORT,
+                        help='port for the plain-text metrics, 0 to disable')
+    args = parser.parse_args()
+
+    pool = BufferPool(args.buffer_size)
+    if args.splice:
+        if hasattr(os, 'splice'):
+            use_splice = True
+        else:
+            print('os.splice is not available, using recv_into/send')
+
+    raise_fd_limit()
+    if args.workers > 0:
+        supervise(args.workers, args.report, args.admin_port)
+        sys.exit(0)
+
+    server_socket = create_server()
+    admin_socket = None
+    if args.admin_port:
+        admin_socket = create_server((server_address[0], args.admin_port))
+
+    try:
+        serve(server_socket, admin_socket=admin_socket)
+    except KeyboardInterrupt:
+        sys.exit(0)
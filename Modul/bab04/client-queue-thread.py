@@ -1,22 +1,98 @@
 #!/usr/bin/env python
 # client.py
+#
+#   python client-queue-thread.py a b c                    (one connection per element)
+#   python client-queue-thread.py --persistent a b c       (one framed connection)
+#   python client-queue-thread.py --persistent --repeat 100000 x
+#   python client-queue-thread.py --persistent --priority 0 --deadline 500 urgent
 
-import sys
+import argparse
 import socket
+import struct
 
+# must match server-queue-thread.py
+MAGIC_PRIORITY = b'\x00QF2'
+FRAME = struct.Struct('!I')
+PRIORITY = struct.Struct('!BI')
+ACK = struct.Struct('!cI')
 
-def main(elements):
+
+def send_one_shot(elements):
+    for e in elements:
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        host = socket.gethostname()
+        client.connect((host, 5001))
+        client.send(bytes(e, encoding='utf-8'))
+        client.shutdown(socket.SHUT_RDWR)
+        client.close()
+
+
+def send_persistent(elements, batch, priority=5, deadline=0):
+    # one connection, frames written back to back without waiting for
+    # replies; the server acknowledges whole batches and we only wait for
+    # the acks at the end. Returns how many were queued, how many the
+    # server turned away as busy and how many it dropped because its queue
+    # was full. Every element carries the priority and the deadline in
+    # milliseconds
+    client = socket.create_connection((socket.gethostname(), 5001))
+    client.sendall(MAGIC_PRIORITY)
+
+    header = PRIORITY.pack(priority, deadline)
+    payloads = [header + bytes(e, encoding='utf-8') for e in elements]
+    for i in range(0, len(payloads), batch):
+        client.sendall(b''.join(FRAME.pack(len(p)) + p for p in payloads[i:i + batch]))
+
+    acked = rejected = dropped = 0
+    buf = bytearray()
+    while acked + rejected + dropped < len(payloads):
+        data = client.recv(4096)
+        if not data:
+            raise ConnectionError('server closed with %d of %d elements acknowledged'
+                                  % (acked, len(payloads)))
+        buf += data
+        offset = 0
+        while len(buf) - offset >= ACK.size:
+            code, count = ACK.unpack_from(buf, offset)
+            if code == b'B':
+                rejected += count
+            elif code == b'D':
+                dropped += count
+            else:
+                acked += count
+            offset += ACK.size
+        del buf[:offset]
+    client.close()
+    return acked, rejected, dropped
+
+
+def main(elements, persistent=False, batch=64, priority=5, deadline=0):
     try:
-        for e in elements:
-            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            host = socket.gethostname()
-            client.connect((host, 5001))
-            client.send(bytes(e, encoding='utf-8'))
-            client.shutdown(socket.SHUT_RDWR)
-            client.close()
+        if persistent:
+            acked, rejected, dropped = send_persistent(elements, batch, priority, deadline)
+            if rejected:
+                print('{} of {} elements rejected, server busy'.format(rejected, len(elements)))
+            if dropped:
+                print('{} of {} elements dropped, server queue full'.format(dropped, len(elements)))
+        else:
+            send_one_shot(elements)
     except Exception as msg:
         print(msg)
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    parser = argparse.ArgumentParser(description='send elements to the queue server')
+    parser.add_argument('elements', nargs='*')
+    parser.add_argument('--persistent', action='store_true',
+                        help='send every element as a frame on one connection')
+    parser.add_argument('--batch', type=int, default=64,
+                        help='frames per send in persistent mode')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='send the elements this many times')
+    parser.add_argument('--priority', type=int, default=5, choices=range(256), metavar='0-255',
+                        help='lower is more urgent, persistent mode only')
+    parser.add_argument('--deadline', type=int, default=0,
+                        help='milliseconds after which the server may skip the elements, '
+                             '0 for none, persistent mode only')
+    args = parser.parse_args()
+
+    main(args.elements * args.repeat, args.persistent, args.batch, args.priority, args.deadline)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# asyncio version of echoserver-thread.py: one thread, one coroutine per client
+# https://docs.python.org/3/library/asyncio-stream.html
+
+import asyncio
+import resource
+import socket
+import sys
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class Server:
+    def __init__(self):
+        self.host = '127.0.0.1'
+        self.port = 5000
+        self.backlog = socket.SOMAXCONN
+        self.size = 1024
+        self.server = None
+
+    async def handle_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        try:
+            while True:
+                data = await reader.read(self.size)
+                if not data:
+                    break
+                writer.write(data)
+                # wait only when the transport buffer is over its high
+                # watermark, so a slow client just pauses its own coroutine
+                await writer.drain()
+        except ConnectionResetError:
+            print('Connection reset', address)
+        finally:
+            writer.close()
+
+    async def wait_for_stdin(self):
+        # like the threaded server, a line on stdin stops the server
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        loop.add_reader(sys.stdin, stop.set_result, None)
+        try:
+            await stop
+        finally:
+            loop.remove_reader(sys.stdin)
+        sys.stdin.readline()
+
+    async def run(self):
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port,
+            backlog=self.backlog, reuse_address=True)
+        print('Listening on', self.host, self.port)
+
+        try:
+            await self.wait_for_stdin()
+        finally:
+            # stop accepting; open sessions are cancelled when asyncio.run()
+            # returns instead of being joined like the threads were
+            self.server.close()
+
+
+if __name__ == "__main__":
+    # one file descriptor per session, allow as many as the hard limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    server = Server()
+    try:
+        asyncio.run(server.run())
+    except KeyboardInterrupt:
+        pass
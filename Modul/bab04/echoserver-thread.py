@@ -1,29 +1,42 @@
 #!/usr/bin/env python
 # http://ilab.cs.byu.edu/python/threadingmodule.html
 
+import argparse
+import queue
 import select
+import selectors
 import socket
 import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Server:
-    def __init__(self):
+    def __init__(self, pool_size=0):
         # self.host = '10.211.55.2'
         self.host = '127.0.0.1'
         self.port = 5000
-        self.backlog = 5
+        self.backlog = socket.SOMAXCONN if pool_size > 0 else 5
         self.size = 1024
         self.server = None
         self.threads = []
+        # pool mode: a fixed number of threads serve readable clients
+        self.pool_size = pool_size
+        self.selector = None
+        self.rearm = queue.SimpleQueue()
+        self.waker = None
 
     def open_socket(self):        
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind((self.host, self.port))
-        self.server.listen(5)
+        self.server.listen(self.backlog)
         
     def run(self):
+        if self.pool_size > 0:
+            self.run_pool()
+            return
+
         self.open_socket()
         input_list = [self.server, sys.stdin]
         running = 1
@@ -37,6 +50,8 @@ class Server:
                     client_socket, client_address = self.server.accept()
                     c = Client(client_socket, client_address)
                     c.start()
+                    # forget the clients that have already finished
+                    self.threads = [t for t in self.threads if t.is_alive()]
                     self.threads.append(c)
 
                 elif s == sys.stdin:
@@ -50,6 +65,85 @@ class Server:
         for c in self.threads:
             c.join()
 
+    def run_pool(self):
+        # the main thread only waits for readiness; a client is handed to
+        # the pool when it has data and rearmed once the echo is done, so
+        # a pool thread never sits blocked in recv() on an idle client, nor
+        # in send() on a client that does not read: the sockets are
+        # non-blocking and an echo that does not fit waits for EVENT_WRITE
+        self.open_socket()
+        self.selector = selectors.DefaultSelector()
+        waker_r, self.waker = socket.socketpair()
+        waker_r.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.selector.register(sys.stdin, selectors.EVENT_READ)
+        self.selector.register(waker_r, selectors.EVENT_READ)
+
+        pool = ThreadPoolExecutor(max_workers=self.pool_size)
+        running = 1
+        while running:
+            for key, _ in self.selector.select():
+                s = key.fileobj
+
+                if s == self.server:
+                    client_socket, client_address = self.server.accept()
+                    client_socket.setblocking(False)
+                    self.selector.register(client_socket, selectors.EVENT_READ, (client_address, b''))
+
+                elif s == sys.stdin:
+                    _ = sys.stdin.readline()
+                    running = 0
+
+                elif s == waker_r:
+                    waker_r.recv(4096)
+                    while not self.rearm.empty():
+                        client_socket, client_address, pending = self.rearm.get()
+                        events = selectors.EVENT_WRITE if pending else selectors.EVENT_READ
+                        self.selector.register(client_socket, events, (client_address, pending))
+
+                else:
+                    self.selector.unregister(s)
+                    pool.submit(self.echo, s, *key.data)
+
+        pool.shutdown(wait=True)
+        while not self.rearm.empty():
+            self.rearm.get()[0].close()
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                key.fileobj.close()
+        self.selector.close()
+        self.server.close()
+        waker_r.close()
+        self.waker.close()
+
+    def echo(self, client, address, pending=b''):
+        # runs on a pool thread when the socket is readable, or writable
+        # while part of the last echo is still pending
+        try:
+            if not pending:
+                try:
+                    pending = client.recv(self.size)
+                except BlockingIOError:
+                    pending = b''
+                else:
+                    if not pending:
+                        client.close()
+                        return
+            if pending:
+                try:
+                    pending = pending[client.send(pending):]
+                except BlockingIOError:
+                    pass
+            self.rearm.put((client, address, pending))
+            self.waker.send(b'x')
+            return
+        except ConnectionResetError:
+            print('Connection reset')
+        except OSError:
+            # the server is shutting down
+            pass
+        client.close()
+
 
 class Client(threading.Thread):
     def __init__(self, client, address):
@@ -71,8 +165,15 @@ class Client(threading.Thread):
                     running = 0
             except ConnectionResetError:
                 print('Connection reset')
+                self.client.close()
+                running = 0
 
 
 if __name__ == "__main__":
-    server = Server()
+    parser = argparse.ArgumentParser(description='threaded echo server')
+    parser.add_argument('--pool', type=int, default=0,
+                        help='serve clients with a fixed pool of this many threads')
+    args = parser.parse_args()
+
+    server = Server(args.pool)
     server.run()
@@ -1,46 +1,579 @@
 #!/usr/bin/env python
 # server.py
 
+import argparse
+import heapq
+import mmap
+import os
 import socket
-import select
-import queue
-from threading import Thread
-from time import sleep
+import selectors
+import struct
+from collections import deque
+from threading import Thread, Condition
+from time import sleep, monotonic, time
 from random import randint
-import sys
+import zlib
+
+
+# every queued element starts with this header: priority (lower is more
+# urgent), deadline (0 for none) and enqueue time, in seconds since the
+# epoch so they keep their meaning in a durable queue across a restart
+ELEMENT = struct.Struct('!Bdd')
+DEFAULT_PRIORITY = 5
+
+
+def pack_element(data, priority=DEFAULT_PRIORITY, deadline=0):
+    return ELEMENT.pack(priority, deadline, time()) + data
+
+
+class Busy(Exception):
+    """Raised by put() on a full queue with the 'busy' policy."""
+
+
+class BatchQueue:
+    """
+    FIFO queue whose consumers take items in batches. Waiting is done on a
+    condition variable, so an idle consumer sleeps until an item arrives
+    or the queue is closed instead of waking up on a timeout.
+
+    When a bounded queue is full, policy decides what put() does:
+    'block' waits for room, 'drop-newest' discards the new item,
+    'drop-oldest' discards the head of the queue to make room and 'busy'
+    raises Busy so the caller can turn the producer away.
+    """
+
+    POLICIES = ('block', 'drop-newest', 'drop-oldest', 'busy')
+
+    def __init__(self, maxsize=0, policy='block'):
+        if policy not in self.POLICIES:
+            raise ValueError('unknown policy {!r}'.format(policy))
+        self.items = deque()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.closed = False
+        self.not_empty = Condition()
+        self.not_full = Condition(self.not_empty)
+        # overload counters, one per policy, and the deepest the queue got
+        self.accepted = 0
+        self.blocked = 0
+        self.dropped_newest = 0
+        self.dropped_oldest = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    # items are kept in memory; the subclasses override these
+    durable = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def _full(self, item):
+        return self.maxsize and len(self) >= self.maxsize
+
+    def _push(self, item):
+        self.items.append(item)
+
+    def _pop(self):
+        return self.items.popleft()
+
+    def _evict(self):
+        # make room under the 'drop-oldest' policy
+        return self._pop()
+
+    def sync(self):
+        """Make everything put so far durable; nothing to do in memory."""
+
+    def ack(self, batch):
+        """A batch from get_batch() has been processed; nothing to do in memory."""
+
+    def put(self, item):
+        """
+        Add an item, applying the overload policy if the queue is full.
+        False if the item was not queued (closed or dropped).
+        """
+        with self.not_full:
+            if not self.closed and self._full(item):
+                if self.policy == 'drop-newest':
+                    self.dropped_newest += 1
+                    return False
+                if self.policy == 'busy':
+                    self.rejected += 1
+                    raise Busy()
+                if self.policy == 'drop-oldest':
+                    while len(self) and self._full(item):
+                        self._evict()
+                        self.dropped_oldest += 1
+                else:
+                    self.blocked += 1
+                    while not self.closed and self._full(item):
+                        self.not_full.wait()
+            if self.closed:
+                return False
+            self._push(item)
+            self.accepted += 1
+            if len(self) > self.max_depth:
+                self.max_depth = len(self)
+            self.not_empty.notify()
+            return True
+
+    def get_batch(self, max_items=1, max_wait=0):
+        """
+        Block until at least one item is queued, then keep collecting for
+        up to max_wait seconds or until max_items are taken. An empty list
+        means the queue is closed and drained.
+        """
+        with self.not_empty:
+            while True:
+                while not len(self) and not self.closed:
+                    self.not_empty.wait()
+
+                deadline = monotonic() + max_wait
+                while len(self) < max_items and not self.closed:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+
+                # another consumer may have emptied the queue while we
+                # waited for more; start over unless it was closed
+                if len(self) or self.closed:
+                    break
+
+            batch = []
+            while len(self) and len(batch) < max_items:
+                batch.append(self._pop())
+            if batch:
+                self.not_full.notify(len(batch))
+            # items left over: hand them to another waiting consumer
+            if len(self):
+                self.not_empty.notify()
+            return batch
+
+    def close(self):
+        """Wake every waiting producer and consumer, put() is refused from now on."""
+        with self.not_empty:
+            self.closed = True
+            self.not_empty.notify_all()
+
+    def qsize(self):
+        return len(self)
+
+    def empty(self):
+        return not len(self)
+
+
+class PriorityQueue(BatchQueue):
+    """
+    BatchQueue that hands out the most urgent element first: lowest
+    priority, then earliest deadline, then arrival order. Under the
+    'drop-oldest' policy it evicts the least urgent element instead of
+    the head.
+    """
+
+    def __init__(self, maxsize=0, policy='block'):
+        BatchQueue.__init__(self, maxsize, policy)
+        self.items = []
+        self.seq = 0    # arrival order, also keeps heap entries unique
+
+    def _push(self, item):
+        priority, deadline, enqueued = ELEMENT.unpack_from(item)
+        self.seq += 1
+        heapq.heappush(self.items, (priority, deadline or float('inf'), self.seq, item))
+
+    def _pop(self):
+        return heapq.heappop(self.items)[-1]
+
+    def _evict(self):
+        # only done on a full queue, a linear scan is fine
+        entry = max(self.items)
+        self.items.remove(entry)
+        heapq.heapify(self.items)
+        return entry[-1]
+
+
+class DiskQueue(BatchQueue):
+    """
+    BatchQueue kept in a fixed-size ring file so queued items survive a
+    restart. The file is split into segments and only the segment being
+    written and the one being read are mapped, so memory use stays at two
+    segments however long the backlog is.
+
+    Records are a length and a CRC followed by the payload and never span
+    two segments. put() only writes to the mapping; sync() writes the
+    header and makes everything put so far durable with one fdatasync, so
+    the caller decides how many items share a commit. After a crash the
+    records between head and tail are checked and the queue is cut at the
+    first one that did not reach the disk. Elements come out in FIFO
+    order; deadlines are still honoured by the workers.
+
+    The head written by sync() only moves past a batch once the consumer
+    has acked it, so a batch that was taken but not processed before a
+    crash is delivered again after the restart.
+    """
+
+    durable = True
+    HEADER = struct.Struct('!8sQQQQQ')   # magic, segment size, segments, head, tail, count
+    RECORD = struct.Struct('!II')        # payload length, crc32
+    MAGIC = b'QRING001'
+    PAD = 0xFFFFFFFF                     # rest of the segment is unused
+    CRC_SEED = 0x51524E47                # a zeroed record must not look valid
+
+    def __init__(self, path, maxsize=0, policy='block', segment_size=4 * 1024 * 1024, segments=64):
+        BatchQueue.__init__(self, maxsize, policy)
+        self.items = None
+        if segment_size % mmap.ALLOCATIONGRANULARITY:
+            raise ValueError('segment size must be a multiple of {}'.format(mmap.ALLOCATIONGRANULARITY))
+        self.path = path
+        self.segment_size = segment_size
+        self.segments = segments
+        self.capacity = segment_size * segments
+        self.max_item = segment_size - self.RECORD.size
+        self.data_offset = mmap.ALLOCATIONGRANULARITY
+        self.windows = {}
+        # batches taken from the queue but not acked yet, oldest first:
+        # [head after the batch, batch or None once acked, element count]
+        self.inflight = deque()
+        self.acked = 0
+        self.unacked = 0
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = self.data_offset + self.capacity
+        if os.fstat(self.fd).st_size < self.data_offset:
+            os.ftruncate(self.fd, size)
+            self.header = mmap.mmap(self.fd, self.data_offset)
+            self.head = self.tail = self.count = 0
+            self.sync()
+        else:
+            self.header = mmap.mmap(self.fd, self.data_offset)
+            magic, segment_size, segments, self.head, self.tail, self.count = \
+                self.HEADER.unpack_from(self.header)
+            if magic != self.MAGIC:
+                raise ValueError('{} is not a queue file'.format(path))
+            if (segment_size, segments) != (self.segment_size, self.segments):
+                raise ValueError('{} was created with {} segments of {} bytes'.format(
+                    path, segments, segment_size))
+            self.recover()
+        self.acked = self.synced_head = self.head
+        self.max_depth = self.count
+
+    def recover(self):
+        # keep the records from head up to the first one that is not intact
+        pos = self.head
+        count = 0
+        while pos < self.tail:
+            item, end = self.read('scan', pos)
+            if item is None or end > self.tail:
+                print('{}: dropping unsynced records after offset {}'.format(self.path, pos))
+                break
+            pos = end
+            count += 1
+        self.tail = pos
+        self.count = count
+        if 'scan' in self.windows:
+            self.windows.pop('scan')[1].close()
+
+    def segment(self, which, pos):
+        # map the segment holding pos in the given window, one mapping each
+        # for the writer and the reader
+        index = pos // self.segment_size % self.segments
+        current = self.windows.get(which)
+        if current is not None:
+            if current[0] == index:
+                return current[1]
+            current[1].close()
+        m = mmap.mmap(self.fd, self.segment_size,
+                      offset=self.data_offset + index * self.segment_size)
+        self.windows[which] = (index, m)
+        return m
+
+    def read(self, which, pos):
+        """Return the record at pos and the position after it, None if it is not intact."""
+        size = self.segment_size
+        while True:
+            offset = pos % size
+            if size - offset < self.RECORD.size:
+                pos += size - offset
+                continue
+            m = self.segment(which, pos)
+            length, crc = self.RECORD.unpack_from(m, offset)
+            if length == self.PAD:
+                pos += size - offset
+                continue
+            if length > size - offset - self.RECORD.size:
+                return None, pos
+            start = offset + self.RECORD.size
+            item = m[start:start + length]
+            if zlib.crc32(item, self.CRC_SEED) != crc:
+                return None, pos
+            return item, pos + self.RECORD.size + length
+
+    def needed(self, length):
+        # bytes a record takes at the tail, including padding to the next segment
+        record = self.RECORD.size + length
+        left = self.segment_size - self.tail % self.segment_size
+        return record if record <= left else left + record
+
+    def __len__(self):
+        return self.count
+
+    def _full(self, item):
+        if BatchQueue._full(self, item):
+            return True
+        # space is only reused once the head that freed it is on disk,
+        # otherwise a crash could replay the header over overwritten records
+        needed = self.needed(len(item))
+        if self.tail + needed - self.synced_head <= self.capacity:
+            return False
+        if self.acked != self.synced_head:
+            self.sync()
+        return self.tail + needed - self.synced_head > self.capacity
+
+    def put(self, item):
+        if len(item) > self.max_item:
+            raise ValueError('item of {} bytes does not fit in a segment'.format(len(item)))
+        return BatchQueue.put(self, item)
+
+    def _push(self, item):
+        size = self.segment_size
+        offset = self.tail % size
+        if size - offset < self.RECORD.size + len(item):
+            if size - offset >= self.RECORD.size:
+                self.RECORD.pack_into(self.segment('write', self.tail), offset, self.PAD, 0)
+            self.tail += size - offset
+            offset = 0
+        m = self.segment('write', self.tail)
+        self.RECORD.pack_into(m, offset, len(item), zlib.crc32(item, self.CRC_SEED))
+        start = offset + self.RECORD.size
+        m[start:start + len(item)] = item
+        self.tail += self.RECORD.size + len(item)
+        self.count += 1
+
+    def _pop(self):
+        item, self.head = self.read('read', self.head)
+        self.count -= 1
+        return item
+
+    def _evict(self):
+        # an evicted item is done with as far as the file is concerned
+        item = self._pop()
+        self.inflight.append([self.head, None, 1])
+        self.unacked += 1
+        self._advance()
+        return item
+
+    def _advance(self):
+        # the durable head moves over the acked batches at the front
+        while self.inflight and self.inflight[0][1] is None:
+            end, batch, count = self.inflight.popleft()
+            self.acked = end
+            self.unacked -= count
+
+    def get_batch(self, max_items=1, max_wait=0):
+        with self.not_empty:
+            batch = BatchQueue.get_batch(self, max_items, max_wait)
+            if batch:
+                self.inflight.append([self.head, batch, len(batch)])
+                self.unacked += len(batch)
+            return batch
+
+    def ack(self, batch):
+        """Let the next sync() drop the batch from the file."""
+        with self.not_empty:
+            for entry in self.inflight:
+                if entry[1] is batch:
+                    entry[1] = None
+                    break
+            self._advance()
+
+    def sync(self):
+        """Write the header and flush the file, one fdatasync for all items put since the last call."""
+        with self.not_empty:
+            self.HEADER.pack_into(self.header, 0, self.MAGIC, self.segment_size, self.segments,
+                                  self.acked, self.tail, self.count + self.unacked)
+            os.fdatasync(self.fd)
+            self.synced_head = self.acked
 
 
 class ProcessThread(Thread):
-    def __init__(self):
-        Thread.__init__(self)
+    def __init__(self, q=None, name=None, batch_size=16, batch_wait=0.05):
+        Thread.__init__(self, name=name)
         self.running = True
-        self.q = queue.Queue()
+        self.q = q if q is not None else BatchQueue()
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        # per-worker metrics
+        self.processed = 0
+        self.batches = 0
+        self.errors = 0
+        self.busy = 0.0
+        # per priority: [count, total latency, max latency] and expired count
+        self.latency = {}
+        self.expired = {}
 
-    def add(self, data):
-        self.q.put(data)
+    def add(self, data, priority=DEFAULT_PRIORITY, deadline=0):
+        self.q.put(pack_element(data, priority, deadline))
 
-    def stop(self):
-        self.running = False
+    def stop(self, drain=False):
+        # with drain=True the worker finishes what is queued before exiting
+        self.running = drain
+        self.q.close()
 
     def run(self):
         q = self.q
-        while self.running:
+        left = []
+        while True:
+            batch = q.get_batch(self.batch_size, self.batch_wait)
+            if not batch:
+                break
+            if not self.running:
+                # stopped without drain while waiting for the batch
+                left = batch
+                break
+
+            # skip the elements that are already too late to be useful
+            now = time()
+            values = []
+            headers = []
+            for item in batch:
+                priority, deadline, enqueued = ELEMENT.unpack_from(item)
+                if deadline and deadline < now:
+                    self.expired[priority] = self.expired.get(priority, 0) + 1
+                    continue
+                values.append(item[ELEMENT.size:])
+                headers.append((priority, enqueued))
+            if not values:
+                q.ack(batch)
+                continue
+
+            start = monotonic()
             try:
-                # block for 1 second only:
-                value = q.get(block=True, timeout=1)
-                process(value)
-            except queue.Empty:
-                sys.stdout.write('.')
-                sys.stdout.flush()
+                failed = set(process_batch(values) or ())
+            except Exception as e:
+                failed = set(range(len(values)))
+                print(self.name, 'failed to process', values, e)
+            self.errors += len(failed)
+            self.processed += len(values) - len(failed)
+            self.batches += 1
+            self.busy += monotonic() - start
+
+            # latency from arrival until the batch is done, successful
+            # elements only
+            now = time()
+            for i, (priority, enqueued) in enumerate(headers):
+                if i in failed:
+                    continue
+                stats = self.latency.setdefault(priority, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += now - enqueued
+                stats[2] = max(stats[2], now - enqueued)
+            # only now may a durable queue forget the batch
+            q.ack(batch)
+
+            if not self.running:
+                break
+
+        # a durable queue keeps its leftovers for the next start
+        if not self.running and not q.durable:
+            if not q.empty():
+                left += q.get_batch(q.qsize())
+            if left:
+                print("Elements left in the queue:")
+                for value in left:
+                    print(value[ELEMENT.size:])
+
+
+class ProcessPool:
+    """
+    N ProcessThreads consuming one bounded queue. What add() does when the
+    queue is full depends on the policy; with the default 'block' it slows
+    the accept loop down instead of letting a burst of clients grow the
+    queue without limit.
+    """
+
+    def __init__(self, workers=4, maxsize=1000, batch_size=16, batch_wait=0.05, policy='block', q=None):
+        self.q = q if q is not None else PriorityQueue(maxsize, policy)
+        self.workers = [ProcessThread(self.q, 'worker-{}'.format(i), batch_size, batch_wait)
+                        for i in range(workers)]
+
+    def start(self):
+        for w in self.workers:
+            w.start()
+
+    def add(self, data, priority=DEFAULT_PRIORITY, deadline=0):
+        return self.q.put(pack_element(data, priority, deadline))
+
+    def commit(self):
+        # called once per batch of add()s before they are acknowledged
+        self.q.sync()
+
+    def stop(self, drain=True):
+        for w in self.workers:
+            w.stop(drain)
+
+    def join(self):
+        for w in self.workers:
+            w.join()
+        self.q.sync()
+
+    def metrics(self):
+        q = self.q
+        lines = [
+            'queue depth: {} (max {}, capacity {})'.format(q.qsize(), q.max_depth, q.maxsize or 'unbounded'),
+            'policy {}: accepted={} blocked={} dropped_newest={} dropped_oldest={} rejected={}'.format(
+                q.policy, q.accepted, q.blocked, q.dropped_newest, q.dropped_oldest, q.rejected),
+        ]
+        if q.durable:
+            lines.append('file {}: {} of {} bytes used'.format(q.path, q.tail - q.acked, q.capacity))
+        for w in self.workers:
+            lines.append('{}: processed={} batches={} errors={} busy={:.1f}s'.format(
+                w.name, w.processed, w.batches, w.errors, w.busy))
+
+        latency = {}
+        expired = {}
+        for w in self.workers:
+            for priority, (count, total, worst) in w.latency.items():
+                stats = latency.setdefault(priority, [0, 0.0, 0.0])
+                stats[0] += count
+                stats[1] += total
+                stats[2] = max(stats[2], worst)
+            for priority, count in w.expired.items():
+                expired[priority] = expired.get(priority, 0) + count
+        for priority in sorted(set(latency) | set(expired)):
+            count, total, worst = latency.get(priority, (0, 0.0, 0.0))
+            lines.append('priority {}: processed={} expired={} latency mean={:.3f}s max={:.3f}s'.format(
+                priority, count, expired.get(priority, 0), total / count if count else 0, worst))
+        return '\n'.join(lines)
+
+
+t = None
+
+# a persistent client starts with MAGIC and then sends length-prefixed
+# frames; every batch of frames read in one recv is acknowledged with a
+# single ACK carrying the number of frames queued; frames turned away by
+# the 'busy' policy are counted in a separate ACK with code B, frames
+# discarded by 'drop-newest' or a closing queue in one with code D. With
+# MAGIC_PRIORITY every frame payload starts with PRIORITY: the priority
+# and a deadline in milliseconds from arrival, 0 for none. MAX_FRAME also
+# limits the element of a one-shot client
+MAGIC = b'\x00QF1'
+MAGIC_PRIORITY = b'\x00QF2'
+FRAME = struct.Struct('!I')
+PRIORITY = struct.Struct('!BI')
+ACK = struct.Struct('!cI')
+MAX_FRAME = 16 * 1024 * 1024
 
-        if not q.empty():
-            print("Elements left in the queue:")
-            while not q.empty():
-                print(q.get())
 
+class Connection:
+    # state of one client connection in the ingest loop
+    __slots__ = ('sock', 'buffer', 'framed', 'outbound', 'events')
 
-t = ProcessThread()
-t.start()
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.framed = None          # unknown until the first bytes arrive, then
+                                    # False, MAGIC or MAGIC_PRIORITY
+        self.outbound = bytearray()
+        self.events = selectors.EVENT_READ
 
 
 def process(value):
@@ -51,7 +584,165 @@ def process(value):
     sleep(randint(1, 5))  # emulating processing time
 
 
+def process_batch(values):
+    """
+    Called with up to --batch-size elements at a time. Override this to
+    handle a whole batch at once; by default every value goes to process().
+    Returns the indexes of the values that failed, nothing if all of them
+    succeeded. If it raises, the whole batch counts as failed.
+    """
+    failed = []
+    for i, value in enumerate(values):
+        try:
+            process(value)
+        except Exception as e:
+            print('failed to process', value, e)
+            failed.append(i)
+    return failed
+
+
+def close(selector, conn):
+    selector.unregister(conn.sock)
+    conn.sock.close()
+
+
+def flush(selector, conn):
+    try:
+        sent = conn.sock.send(conn.outbound)
+        del conn.outbound[:sent]
+    except BlockingIOError:
+        pass
+    except ConnectionError:
+        close(selector, conn)
+        return
+    events = selectors.EVENT_READ
+    if conn.outbound:
+        events |= selectors.EVENT_WRITE
+    if events != conn.events:
+        conn.events = events
+        selector.modify(conn.sock, events, conn)
+
+
+def read_frames(selector, conn):
+    # queue every complete frame in the buffer and acknowledge them at once
+    buf = conn.buffer
+    offset = 0
+    count = 0
+    busy = 0
+    dropped = 0
+    while len(buf) - offset >= FRAME.size:
+        size, = FRAME.unpack_from(buf, offset)
+        if size > MAX_FRAME:
+            print("Frame too large, closing connection")
+            close(selector, conn)
+            return
+        end = offset + FRAME.size + size
+        if end > len(buf):
+            break
+        start = offset + FRAME.size
+        priority, deadline = DEFAULT_PRIORITY, 0
+        if conn.framed == MAGIC_PRIORITY:
+            if size < PRIORITY.size:
+                print("Frame without priority header, closing connection")
+                close(selector, conn)
+                return
+            priority, timeout = PRIORITY.unpack_from(buf, start)
+            if timeout:
+                deadline = time() + timeout / 1000
+            start += PRIORITY.size
+        try:
+            if t.add(bytes(buf[start:end]), priority, deadline):
+                count += 1
+            else:
+                dropped += 1
+        except (Busy, ValueError):
+            # ValueError: too large for a segment of the durable queue
+            busy += 1
+        offset = end
+    del buf[:offset]
+
+    if count:
+        t.commit()
+        conn.outbound += ACK.pack(b'A', count)
+    if busy:
+        conn.outbound += ACK.pack(b'B', busy)
+    if dropped:
+        conn.outbound += ACK.pack(b'D', dropped)
+    if count or busy or dropped:
+        flush(selector, conn)
+
+
+def handle_read(selector, conn):
+    try:
+        data = conn.sock.recv(65536)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        data = b''
+
+    if not data:
+        # a one-shot client sends its element and closes
+        if not conn.framed and conn.buffer:
+            try:
+                t.add(bytes(conn.buffer))
+                t.commit()
+            except Busy:
+                pass    # the client is gone, only the counter records it
+            except ValueError as e:
+                print("Element dropped: {}".format(e))
+        close(selector, conn)
+        return
+
+    conn.buffer += data
+    if conn.framed is None:
+        if conn.buffer[0] != 0:
+            conn.framed = False
+        elif len(conn.buffer) >= len(MAGIC):
+            magic = bytes(conn.buffer[:len(MAGIC)])
+            conn.framed = magic if magic in (MAGIC, MAGIC_PRIORITY) else False
+            if conn.framed:
+                del conn.buffer[:len(MAGIC)]
+
+    if conn.framed:
+        read_frames(selector, conn)
+    elif conn.framed is False and len(conn.buffer) > MAX_FRAME:
+        # a one-shot element is held until EOF, no larger than a frame
+        print("Element too large, closing connection")
+        close(selector, conn)
+
+
 def main():
+    global t, MAX_FRAME
+    parser = argparse.ArgumentParser(description='queue server')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of threads processing the queue')
+    parser.add_argument('--queue-size', type=int, default=None,
+                        help='maximum number of queued elements (default 1000, '
+                             'unlimited with --durable where the file size is the limit)')
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='maximum number of elements per process_batch() call')
+    parser.add_argument('--batch-wait', type=float, default=50,
+                        help='milliseconds to wait for a batch to fill up')
+    parser.add_argument('--policy', choices=BatchQueue.POLICIES, default='block',
+                        help='what to do with new elements while the queue is full')
+    parser.add_argument('--durable', metavar='PATH',
+                        help='keep the queue in this ring file so it survives restarts')
+    parser.add_argument('--segment-size', type=int, default=4096,
+                        help='KiB per ring file segment, also the largest element')
+    parser.add_argument('--segments', type=int, default=64,
+                        help='number of segments in the ring file')
+    args = parser.parse_args()
+
+    q = None
+    if args.durable:
+        q = DiskQueue(args.durable, args.queue_size or 0, args.policy,
+                      args.segment_size * 1024, args.segments)
+        MAX_FRAME = min(MAX_FRAME, q.max_item - ELEMENT.size)
+        print("Recovered {} queued elements from {}".format(q.qsize(), args.durable))
+    t = ProcessPool(args.workers, args.queue_size or 1000, args.batch_size, args.batch_wait / 1000,
+                    args.policy, q)
+    t.start()
+
     s = socket.socket()             # Create a socket object
     host = socket.gethostname()     # Get local machine name
     port = 5001                     # Reserve a port for your service.
@@ -59,26 +750,52 @@ def main():
     print("Listening on port {p}...".format(p=port))
 
     s.listen(5)  # Now wait for client connection.
-    while True:
-        try:
-            client, address = s.accept()
-            ready = select.select([client, ], [], [], 2)
-            if ready[0]:
-                data = client.recv(4096)
-                # print data
-                t.add(data)
-        except KeyboardInterrupt:
-            print("Stop.")
-            break
-        except socket.error:
-            print("Socket error!")
-            break
-    cleanup()
+    s.setblocking(False)
+
+    # one-shot clients and persistent framed clients share one loop
+    selector = selectors.DefaultSelector()
+    selector.register(s, selectors.EVENT_READ, None)
+    try:
+        while True:
+            try:
+                for key, mask in selector.select():
+                    conn = key.data
+                    if conn is None:
+                        client, address = s.accept()
+                        client.setblocking(False)
+                        conn = Connection(client)
+                        selector.register(client, conn.events, conn)
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        flush(selector, conn)
+                    if mask & selectors.EVENT_READ and conn.sock.fileno() != -1:
+                        handle_read(selector, conn)
+            except BlockingIOError:
+                continue
+            except KeyboardInterrupt:
+                print("Stop.")
+                break
+            except socket.error:
+                print("Socket error!")
+                break
+    finally:
+        # also when the loop died on an error, the workers would keep the
+        # process alive
+        cleanup()
 
 
 def cleanup():
-    t.stop()
-    t.join()
+    if t.q.durable:
+        # finish the batches in progress, the rest stays in the file
+        t.stop(drain=False)
+        t.join()
+        print("Keeping {} queued elements in {}".format(t.q.qsize(), t.q.path))
+    else:
+        # let the workers finish what is already queued
+        print("Draining {} queued elements...".format(t.q.qsize()))
+        t.stop(drain=True)
+        t.join()
+    print(t.metrics())
 
 
 if __name__ == "__main__":
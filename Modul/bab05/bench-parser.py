@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# compare the incremental RequestParser of the ETS/EAS servers with the
+# split() based get_header it replaced, prints ns per request as JSON
+#
+#   python bench-parser.py -n 20000
+
+import argparse
+import importlib.util
+import json
+import os
+import timeit
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+SOLUTION = os.path.join(HERE, '..', '..', 'ETS', 'server-403', 'solution.py')
+
+SIMPLE = b'GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n'
+BROWSER = (b'GET /index.html HTTP/1.1\r\n'
+           b'Host: localhost:8080\r\n'
+           b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0\r\n'
+           b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n'
+           b'Accept-Language: en-US,en;q=0.5\r\n'
+           b'Accept-Encoding: gzip, deflate, br\r\n'
+           b'Connection: keep-alive\r\n'
+           b'Upgrade-Insecure-Requests: 1\r\n'
+           b'Sec-Fetch-Dest: document\r\n'
+           b'Sec-Fetch-Mode: navigate\r\n'
+           b'Sec-Fetch-Site: none\r\n'
+           b'\r\n')
+
+
+def load_parser():
+    spec = importlib.util.spec_from_file_location('server403', SOLUTION)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.RequestParser
+
+
+def split_get_header(data):
+    # the old get_header without its print
+    header, body = data.split('\r\n\r\n')
+    request, host = header.split('\r\n')
+    return request.split(' ')[1]
+
+
+def split_pieces(pieces):
+    # what a split() server has to do when a request arrives in pieces:
+    # look for the end of the header in everything received on every recv
+    data = b''
+    for piece in pieces:
+        data += piece
+        if data.find(b'\r\n\r\n') >= 0:
+            return data.decode('utf-8').split('\r\n')[0].split(' ')[1]
+
+
+def parse_pieces(RequestParser, pieces):
+    parser = RequestParser()
+    for piece in pieces:
+        parser.feed(piece)
+        request = parser.next_request()
+        if request is not None:
+            return request.target
+
+
+def measure(func, number):
+    return round(min(timeit.repeat(func, number=number, repeat=5)) / number * 1e9)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTTP request parser benchmark')
+    parser.add_argument('-n', '--number', type=int, default=20000, help='requests per measurement')
+    parser.add_argument('--piece', type=int, default=16, help='bytes per recv in the trickle case')
+    args = parser.parse_args()
+
+    RequestParser = load_parser()
+    simple = SIMPLE.decode()
+    pieces = [BROWSER[i:i + args.piece] for i in range(0, len(BROWSER), args.piece)]
+
+    try:
+        split_get_header(BROWSER.decode())
+        browser_split = measure(lambda: split_get_header(BROWSER.decode()), args.number)
+    except ValueError:
+        browser_split = 'fails'
+
+    results = {
+        'simple_ns': {
+            'split': measure(lambda: split_get_header(simple), args.number),
+            'parser': measure(lambda: parse_pieces(RequestParser, [SIMPLE]), args.number),
+        },
+        'browser_ns': {
+            'split': browser_split,
+            'parser': measure(lambda: parse_pieces(RequestParser, [BROWSER]), args.number),
+        },
+        'trickle_ns': {
+            'pieces': len(pieces),
+            'split': measure(lambda: split_pieces(pieces), args.number),
+            'parser': measure(lambda: parse_pieces(RequestParser, pieces), args.number),
+        },
+    }
+    print(json.dumps(results, indent=2))
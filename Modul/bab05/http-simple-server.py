@@ -1,54 +1,728 @@
+import argparse
+import gzip
+import importlib.util
+import mimetypes
+import os
 import socket
-import select
+import selectors
 import sys
+import time
+import zlib
+from collections import deque, OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import unquote
 
 server_address = ('localhost', 8080)
+# plain-text metrics are served on this port
+admin_address = ('localhost', 9180)
+
+# stop reading from a client once this many bytes are waiting to be sent
+# to it, and resume once the backlog has drained below the low watermark
+HIGH_WATERMARK = 256 * 1024
+LOW_WATERMARK = 64 * 1024
+
+# rendered responses kept in memory, files larger than MAX_CACHED_FILE are
+# never cached but streamed with sendfile; a cached file is stat()ed at
+# most every REVALIDATE seconds
+CACHE_BYTES = 16 * 1024 * 1024
+MAX_CACHED_FILE = 1024 * 1024
+REVALIDATE = 1.0
+# bytes per sendfile call, so one big download cannot starve the others
+SENDFILE_CHUNK = 1024 * 1024
+
+# types worth compressing when the client accepts gzip or deflate
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'application/xml',
+                'image/svg+xml')
+ENCODINGS = ('gzip', 'deflate')
+
+# only files of these types are served, so the server's own source and
+# whatever else sits next to the documents stay private
+SERVED_TYPES = ('text/html', 'text/css', 'text/plain', 'application/javascript',
+                'application/json', 'application/pdf', 'application/octet-stream',
+                'image/', 'font/', 'audio/', 'video/')
+
+# more ranges than this in one request get the whole body instead
+MAX_RANGES = 16
+BOUNDARY = os.urandom(12).hex()
+
+# a request header larger than this is refused
+MAX_HEADER = 16 * 1024
+
+NOT_FOUND = b'HTTP/1.1 404 Not found\r\nContent-Length: 0\r\n\r\n'
+# responses to requests the parser rejects, by ParseError.status
+ERRORS = {
+    400: b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n',
+    413: b'HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\n\r\n',
+    431: b'HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Length: 0\r\n\r\n',
+}
+
+
+# the request parser and the timer wheel are the ones of the ETS server,
+# loaded from its single-file solution like bench-parser.py does
+SHARED = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                      '..', '..', 'ETS', 'server-403', 'solution.py')
+
+
+def load_shared():
+    spec = importlib.util.spec_from_file_location('server403', SHARED)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+shared = load_shared()
+ParseError = shared.ParseError
+RequestParser = shared.RequestParser
+TimerWheel = shared.TimerWheel
+
+
+class Stats:
+    # process-wide counters; only integer increments on the hot path,
+    # the text is rendered when the admin port is scraped
+    READY_BUCKETS = (1, 4, 16, 64, 256, 1024, 4096)
+
+    def __init__(self):
+        self.accepted = 0
+        self.closed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.requests = 0
+        self.loops = 0
+        self.handler_ns = 0
+        self.ready_events = 0
+        # ready-set size histogram, bucket i counts sizes <= 4**i
+        self.ready_sizes = [0] * (len(self.READY_BUCKETS) + 1)
+
+    def observe_ready(self, n):
+        self.loops += 1
+        self.ready_events += n
+        self.ready_sizes[min((max(n, 1) - 1).bit_length() + 1 >> 1, len(self.READY_BUCKETS))] += 1
+
+
+stats = Stats()
+
+
+class Variant:
+    # one representation of a file: the header fields shared by its 200,
+    # 206 and 304 responses, and either the rendered 200 response or, for
+    # files too large to cache, the path to stream the body from
+    __slots__ = ('response', 'body_offset', 'length', 'content_type', 'fields', 'etag',
+                 'last_modified', 'modified', 'mtime', 'size', 'checked', 'path')
+
+    def __init__(self, path, st, body, content_type, encoding):
+        self.path = path
+        self.content_type = content_type
+        self.mtime = st.st_mtime_ns
+        self.size = st.st_size
+        self.modified = int(st.st_mtime)
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+
+        # strong validator, different for every coding of the same file
+        fields = ''
+        tag = '%x-%x-%x' % (st.st_ino, st.st_mtime_ns, st.st_size)
+        if compressible(content_type):
+            fields = 'Vary: Accept-Encoding\r\n'
+            compressed = None
+            if encoding == 'gzip':
+                compressed = gzip.compress(body, 9, mtime=0)
+            elif encoding == 'deflate':
+                compressed = zlib.compress(body, 9)
+            # only worth it if it is actually smaller
+            if compressed is not None and len(compressed) < len(body):
+                body = compressed
+                fields += 'Content-Encoding: ' + encoding + '\r\n'
+                tag += '-' + encoding
+        self.etag = '"' + tag + '"'
+        self.fields = (fields + 'Accept-Ranges: bytes\r\nETag: ' + self.etag
+                       + '\r\nLast-Modified: ' + self.last_modified + '\r\n')
+
+        if body is None:
+            self.response = None
+            self.body_offset = 0
+            self.length = st.st_size
+        else:
+            header = render_header(200, 'OK', len(body), content_type, self.fields)
+            self.response = header + body
+            self.body_offset = len(header)
+            self.length = len(body)
+
+    def body(self, start, length):
+        # part of the body, from the cached response without a copy or
+        # as a FileBody to send straight from the file
+        if self.response is not None:
+            offset = self.body_offset + start
+            return memoryview(self.response)[offset:offset + length]
+        return FileBody(open(self.path, 'rb'), start, length)
+
+
+class ResponseCache:
+    """
+    LRU cache of Variants, fully rendered responses (status line, headers
+    and body) keyed by file path and content coding, bounded by the total
+    size of the responses. An entry is trusted for REVALIDATE seconds,
+    after that its mtime and size are checked with os.stat and the
+    response is rebuilt if they changed, so a file is compressed once per
+    version.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.entries = OrderedDict()    # (path, encoding) -> Variant
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, content_type, encoding=None):
+        """
+        Variant of path in the given content coding (None for identity).
+        Files too large to cache get a Variant without a rendered response.
+        Raises OSError if the file cannot be read.
+        """
+        key = (path, encoding)
+        now = time.monotonic()
+        variant = self.entries.get(key)
+        if variant is not None:
+            if now - variant.checked < REVALIDATE:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return variant
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.discard(key)
+                raise
+            if (st.st_mtime_ns, st.st_size) == (variant.mtime, variant.size):
+                variant.checked = now
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return variant
+            self.discard(key)
+
+        self.misses += 1
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_size > MAX_CACHED_FILE:
+                # streamed with sendfile, only its validators are needed
+                return Variant(path, st, None, content_type, None)
+            body = f.read()
+        variant = Variant(path, st, body, content_type, encoding)
+        variant.checked = now
+        self.entries[key] = variant
+        self.bytes += len(variant.response)
+        while self.bytes > self.max_bytes:
+            key, old = self.entries.popitem(last=False)
+            self.bytes -= len(old.response)
+        return variant
+
+    def discard(self, key):
+        variant = self.entries.pop(key, None)
+        if variant is not None:
+            self.bytes -= len(variant.response)
+
+
+cache = ResponseCache()
+
+
+def render_header(status, reason, content_length, content_type, fields=''):
+    return ('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s\r\n'
+            % (status, reason, content_type, content_length, fields)).encode('utf-8')
+
+
+def compressible(content_type):
+    return content_type.startswith(COMPRESSIBLE)
+
+
+def negotiate_encoding(accept_encoding):
+    # the coding from ENCODINGS the client prefers, None for identity;
+    # on equal weights the earlier one in ENCODINGS wins
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for coding in ENCODINGS:
+        q = weights.get(coding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class Connection:
+    # per-connection state, stored as the selector key data
+    __slots__ = ('sock', 'address', 'outbound', 'pending', 'reading', 'closing', 'closed',
+                 'events', 'bytes_in', 'bytes_out', 'requests', 'admin', 'parser', 'progress')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.outbound = deque()     # memoryviews and FileBodys waiting to be sent
+        self.pending = 0            # bytes in outbound
+        self.reading = True
+        self.closing = False        # close once outbound is sent
+        self.closed = False
+        self.events = selectors.EVENT_READ
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.requests = 0
+        self.admin = False          # a metrics scrape, not an HTTP client
+        self.parser = RequestParser(MAX_HEADER)
+        self.progress = 0           # bytes_out when the idle timer was last checked
+
+
+class FileBody:
+    # a file in the outbound queue, sent straight from the page cache
+    __slots__ = ('file', 'offset', 'remaining')
+
+    def __init__(self, file, offset, remaining):
+        self.file = file
+        self.offset = offset
+        self.remaining = remaining
+
+
+def close(selector, conn):
+    # a send can fail while a request is answered, every caller after
+    # that sees closed and closing set, and closing twice does nothing
+    if conn.closed:
+        return
+    conn.closed = conn.closing = True
+    selector.unregister(conn.sock)
+    conn.sock.close()
+    timers.cancel(conn)
+    for item in conn.outbound:
+        if isinstance(item, FileBody):
+            item.file.close()
+    if not conn.admin:
+        stats.closed += 1
+
+
+def update_events(selector, conn):
+    if conn.reading and conn.pending >= HIGH_WATERMARK:
+        conn.reading = False
+    elif not conn.reading and conn.pending <= LOW_WATERMARK:
+        conn.reading = True
+
+    events = 0
+    if conn.reading and not conn.closing:
+        events |= selectors.EVENT_READ
+    if conn.outbound:
+        events |= selectors.EVENT_WRITE
+
+    if events != conn.events:
+        conn.events = events
+        selector.modify(conn.sock, events, conn)
+
+
+def flush(selector, conn):
+    if conn.closed:
+        return
+    outbound = conn.outbound
+    try:
+        while outbound:
+            view = outbound[0]
+            if isinstance(view, FileBody):
+                sent = os.sendfile(conn.sock.fileno(), view.file.fileno(), view.offset,
+                                   min(view.remaining, SENDFILE_CHUNK))
+                if not sent:
+                    # the file got shorter, the response cannot be completed
+                    close(selector, conn)
+                    return
+                view.offset += sent
+                view.remaining -= sent
+                conn.bytes_out += sent
+                stats.bytes_out += sent
+                if view.remaining:
+                    # let the other connections have a turn
+                    break
+                view.file.close()
+                outbound.popleft()
+                continue
+            sent = conn.sock.send(view)
+            conn.pending -= sent
+            conn.bytes_out += sent
+            stats.bytes_out += sent
+            if sent < len(view):
+                outbound[0] = view[sent:]
+                break
+            outbound.popleft()
+    except BlockingIOError:
+        pass
+    except ConnectionError:
+        close(selector, conn)
+        return
+
+    if conn.closing and not outbound:
+        close(selector, conn)
+    else:
+        update_events(selector, conn)
+
+
+def write(selector, conn, *parts):
+    # queue all parts before flushing, a closing connection is closed as
+    # soon as the queue runs empty
+    if conn.closed:
+        for data in parts:
+            if isinstance(data, FileBody):
+                data.file.close()
+        return
+    idle = not conn.outbound
+    for data in parts:
+        if isinstance(data, FileBody):
+            # takes no memory, does not count towards pending
+            conn.outbound.append(data)
+        elif len(data):
+            conn.outbound.append(memoryview(data))
+            conn.pending += len(data)
+    if idle:
+        flush(selector, conn)
+    else:
+        update_events(selector, conn)
+
+
+def write_response(selector, conn, response, *body):
+    # the last response on a connection says so; the body of a cached
+    # response is still sent from the cache without a copy
+    if conn.closing:
+        end = response.index(b'\r\n\r\n') + 2
+        write(selector, conn, response[:end] + b'Connection: close\r\n\r\n',
+              memoryview(response)[end + 2:], *body)
+    else:
+        write(selector, conn, response, *body)
+
+
+def not_modified(request, variant):
+    # If-None-Match wins over If-Modified-Since when both are sent
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == variant.etag:
+                return True
+        return False
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            return variant.modified <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            pass
+    return False
+
+
+def parse_ranges(value, size):
+    # [(start, length)] for a Range header, None if the header is to be
+    # ignored and the whole body sent, [] if no range can be satisfied
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for item in spec.split(','):
+        first, dash, last = item.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = size - 1
+                if last:
+                    end = int(last)
+                    if end < start:
+                        return None
+            else:
+                # the last n bytes
+                start = max(0, size - int(last))
+                end = size - 1 if int(last) else -1
+        except ValueError:
+            return None
+        if start < size and end >= start:
+            ranges.append((start, min(end, size - 1) - start + 1))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def send_ranges(selector, conn, variant, ranges):
+    size = variant.length
+    if not ranges:
+        write_response(selector, conn, ('HTTP/1.1 416 Range Not Satisfiable\r\n'
+                                        'Content-Range: bytes */%d\r\nContent-Length: 0\r\n\r\n'
+                                        % size).encode('utf-8'))
+        return
+
+    if len(ranges) == 1:
+        start, length = ranges[0]
+        fields = 'Content-Range: bytes %d-%d/%d\r\n' % (start, start + length - 1, size) + variant.fields
+        header = render_header(206, 'Partial Content', length, variant.content_type, fields)
+        write_response(selector, conn, header, variant.body(start, length))
+        return
+
+    # multipart/byteranges, every part has its own small header
+    parts = []
+    total = 0
+    for start, length in ranges:
+        part_header = ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+                       % (BOUNDARY, variant.content_type, start, start + length - 1, size)).encode('utf-8')
+        parts += [part_header, variant.body(start, length), b'\r\n']
+        total += len(part_header) + length + 2
+    closing = ('--%s--\r\n' % BOUNDARY).encode('utf-8')
+    parts.append(closing)
+    total += len(closing)
+    header = render_header(206, 'Partial Content', total,
+                           'multipart/byteranges; boundary=' + BOUNDARY, variant.fields)
+    write_response(selector, conn, header, *parts)
+
+
+def resolve(request_file):
+    # map the request path to a regular file under the document root, None
+    # if there is no such file, it is not of a type in SERVED_TYPES or the
+    # path leaves the root, by itself or through a symlink
+    path = unquote(request_file.split('?', 1)[0]).lstrip('/') or 'index.html'
+    path = os.path.normpath(path)
+    if any(part.startswith('.') for part in path.split(os.sep)) or os.path.isabs(path):
+        return None
+    content_type = mimetypes.guess_type(path)[0]
+    if content_type is None or not content_type.startswith(SERVED_TYPES):
+        return None
+    path = os.path.join(document_root, path)
+    if os.path.realpath(path) != path or not os.path.isfile(path):
+        return None
+    return path
+
+
+def content_type_of(path):
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if content_type.startswith('text/'):
+        content_type += '; charset=UTF-8'
+    return content_type
+
+
+def handle_request(selector, conn):
+    # receive data from client, close when null received
+    try:
+        data = conn.sock.recv(4096)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        close(selector, conn)
+        return
+    if args.debug:
+        print('data:', data)
+    conn.bytes_in += len(data)
+    stats.bytes_in += len(data)
+
+    if not data:
+        if conn.outbound:
+            conn.closing = True
+            update_events(selector, conn)
+        else:
+            close(selector, conn)
+        return
+
+    # answer every complete request in the buffer, in order; pipelined
+    # responses queue up behind each other in outbound
+    conn.parser.feed(data)
+    while not conn.closing:
+        try:
+            request = conn.parser.next_request()
+        except ParseError as e:
+            conn.closing = True
+            write_response(selector, conn, ERRORS[e.status])
+            break
+        if request is None:
+            break
+        respond(selector, conn, request)
+
+    if not conn.closing:
+        timers.schedule(conn, args.keepalive_timeout)
+
+
+def respond(selector, conn, request):
+    conn.requests += 1
+    stats.requests += 1
+    if args.debug:
+        print('request header:', request.head.split('\r\n') + ['', ''])
+    if not request.keep_alive or conn.requests >= args.max_requests:
+        conn.closing = True
+
+    path = resolve(request.target)
+    if path is not None:
+        content_type = content_type_of(path)
+        try:
+            encoding = None
+            if compressible(content_type):
+                encoding = negotiate_encoding(request.headers.get('accept-encoding', ''))
+            variant = cache.get(path, content_type, encoding)
+
+            ranges = None
+            if not_modified(request, variant):
+                write_response(selector, conn, ('HTTP/1.1 304 Not Modified\r\n' + variant.fields
+                                                + '\r\n').encode('utf-8'))
+                return
+            if 'range' in request.headers:
+                # If-Range: only a range of the version the client already has
+                if_range = request.headers.get('if-range')
+                if if_range is None or if_range in (variant.etag, variant.last_modified):
+                    ranges = parse_ranges(request.headers['range'], variant.length)
+
+            if ranges is not None:
+                send_ranges(selector, conn, variant, ranges)
+            elif variant.response is not None:
+                write_response(selector, conn, variant.response)
+            else:
+                header = render_header(200, 'OK', variant.length, content_type, variant.fields)
+                write_response(selector, conn, header, variant.body(0, variant.length))
+        except OSError:
+            write_response(selector, conn, NOT_FOUND)
+
+    else:
+        write_response(selector, conn, NOT_FOUND)
+
+
+def render_metrics(selector):
+    # Prometheus text exposition format
+    lines = [
+        '# TYPE http_connections_accepted_total counter',
+        'http_connections_accepted_total %d' % stats.accepted,
+        '# TYPE http_connections_closed_total counter',
+        'http_connections_closed_total %d' % stats.closed,
+        '# TYPE http_received_bytes_total counter',
+        'http_received_bytes_total %d' % stats.bytes_in,
+        '# TYPE http_sent_bytes_total counter',
+        'http_sent_bytes_total %d' % stats.bytes_out,
+        '# TYPE http_requests_total counter',
+        'http_requests_total %d' % stats.requests,
+        '# TYPE http_loop_iterations_total counter',
+        'http_loop_iterations_total %d' % stats.loops,
+        '# TYPE http_handler_seconds_total counter',
+        'http_handler_seconds_total %.6f' % (stats.handler_ns / 1e9),
+        '# TYPE http_cache_hits_total counter',
+        'http_cache_hits_total %d' % cache.hits,
+        '# TYPE http_cache_misses_total counter',
+        'http_cache_misses_total %d' % cache.misses,
+        '# TYPE http_cache_entries gauge',
+        'http_cache_entries %d' % len(cache.entries),
+        '# TYPE http_cache_bytes gauge',
+        'http_cache_bytes %d' % cache.bytes,
+        '# TYPE http_ready_set_size histogram',
+    ]
+    cumulative = 0
+    for bound, count in zip(stats.READY_BUCKETS + ('+Inf',), stats.ready_sizes):
+        cumulative += count
+        lines.append('http_ready_set_size_bucket{le="%s"} %d' % (bound, cumulative))
+    lines.append('http_ready_set_size_sum %d' % stats.ready_events)
+    lines.append('http_ready_set_size_count %d' % stats.loops)
+
+    # open connections are summarised, not listed one by one, so the
+    # scrape stays the same size however many clients are connected
+    per_connection = (
+        ('http_connection_received_bytes', 'bytes_in'),
+        ('http_connection_sent_bytes', 'bytes_out'),
+        ('http_connection_requests', 'requests'),
+    )
+    conns = [key.data for key in selector.get_map().values()
+             if isinstance(key.data, Connection) and not key.data.admin]
+    lines.append('# TYPE http_connections_open gauge')
+    lines.append('http_connections_open %d' % len(conns))
+    for name, attr in per_connection:
+        values = [getattr(conn, attr) for conn in conns]
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s{stat="sum"} %d' % (name, sum(values)))
+        lines.append('%s{stat="max"} %d' % (name, max(values, default=0)))
+
+    body = ('\n'.join(lines) + '\n').encode()
+    return (b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+            b'Content-Length: %d\r\n\r\n' % len(body)) + body
+
+
+def scrape(selector, conn):
+    # any request on the admin port gets the metrics
+    try:
+        conn.sock.recv(4096)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        close(selector, conn)
+        return
+    conn.closing = True
+    write(selector, conn, render_metrics(selector))
+
+
+parser = argparse.ArgumentParser(description='simple HTTP server')
+parser.add_argument('--max-requests', type=int, default=100,
+                    help='requests served on one connection before it is closed')
+parser.add_argument('--keepalive-timeout', type=float, default=5,
+                    help='seconds an idle keep-alive connection is kept open')
+parser.add_argument('--debug', action='store_true',
+                    help='print every chunk received and every request header')
+parser.add_argument('--root', default='.',
+                    help='directory the files are served from')
+args = parser.parse_args()
+document_root = os.path.realpath(args.root)
+
+# idle keep-alive connections, keyed by Connection
+timers = TimerWheel(span=args.keepalive_timeout)
+
 server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 server_socket.bind(server_address)
 server_socket.listen(5)
+server_socket.setblocking(False)
+
+admin_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+admin_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+admin_socket.bind(admin_address)
+admin_socket.listen(5)
+admin_socket.setblocking(False)
 
-input_socket = [server_socket]
+selector = selectors.DefaultSelector()
+selector.register(server_socket, selectors.EVENT_READ, None)
+selector.register(admin_socket, selectors.EVENT_READ, 'admin')
 
 try:
     while True:
-        read_ready, write_ready, exception = select.select(input_socket, [], [])
-        
-        for sock in read_ready:
-            if sock == server_socket:
-                client_socket, client_address = server_socket.accept()
-                input_socket.append(client_socket)                       
-            
-            else:                
-                # receive data from client, break when null received          
-                data = sock.recv(4096)
-                print('data:', data)
-                
-                if data:
-                    data = data.decode('utf-8')
-                    request_header = data.split('\r\n')
-                    print('request header:', request_header)
-                    request_file = request_header[0].split()[1]
-                    response_header = b''
-                    response_data = b''
-                    
-                    if request_file == 'index.html' or request_file == '/' or request_file == '/index.html':
-                        f = open('index.html', 'r')
-                        response_data = f.read()
-                        f.close()
-                        
-                        content_length = len(response_data)
-                        response_header = 'HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=UTF-8\r\nContent-Length: ' \
-                                        + str(content_length) + '\r\n\r\n'
-
-                        sock.sendall(response_header.encode('utf-8') + response_data.encode('utf-8'))
-
-                    else:
-                        sock.sendall(b'HTTP/1.1 404 Not found\r\n\r\n')
+        events = selector.select(timers.next_timeout())
+        start = time.perf_counter_ns()
+        stats.observe_ready(len(events))
+
+        for conn in timers.expire():
+            if conn.outbound and conn.bytes_out != conn.progress:
+                # still downloading, not idle
+                conn.progress = conn.bytes_out
+                timers.schedule(conn, args.keepalive_timeout)
+            else:
+                close(selector, conn)
+
+        for key, mask in events:
+            conn = key.data
+            if conn is None or conn == 'admin':
+                listener = server_socket if conn is None else admin_socket
+                client_socket, client_address = listener.accept()
+                client_socket.setblocking(False)
+                conn = Connection(client_socket, client_address)
+                conn.admin = listener is admin_socket
+                if not conn.admin:
+                    stats.accepted += 1
+                    timers.schedule(conn, args.keepalive_timeout)
+                selector.register(client_socket, conn.events, conn)
+                continue
+
+            if mask & selectors.EVENT_WRITE:
+                flush(selector, conn)
+            if mask & selectors.EVENT_READ and not conn.closed:
+                if conn.admin:
+                    scrape(selector, conn)
                 else:
-                    input_socket.remove(sock)
-                    sock.close()
+                    handle_request(selector, conn)
+
+        stats.handler_ns += time.perf_counter_ns() - start
 
-except KeyboardInterrupt:        
+except KeyboardInterrupt:
     server_socket.close()
+    admin_socket.close()
     sys.exit(0)
@@ -2,38 +2,150 @@
 import socket
 import select
 import sys
+import os
+import time
+import signal
+import struct
+import mmap
+import argparse
 
-# creating socket server object, bind, and listen
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind(('localhost', 5000))
-server_socket.listen(5)
+# SO_REUSEPORT is not exported by every socket module, 15 on Linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 
-# list to store accepted client
-input_list = [server_socket]
+# shared counters for each worker: messages and bytes echoed
+COUNTER = struct.Struct('QQ')
+
+
+def create_server(reuse_port=False):
+    # creating socket server object, bind, and listen
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reuse_port:
+        # every worker binds its own socket on the same port
+        server_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    server_socket.bind(('localhost', 5000))
+    server_socket.listen(5)
+    return server_socket
+
+
+def serve(server_socket, counters=None, slot=0):
+    # list to store accepted client
+    input_list = [server_socket]
+    messages = 0
+    total_bytes = 0
+    if counters is not None:
+        # a restarted worker carries on from its predecessor's totals so
+        # the supervisor's rates never go backwards
+        messages, total_bytes = COUNTER.unpack_from(counters, slot * COUNTER.size)
 
-try:
     while 1:
         # serving multiple client alternately; one socket in a time
         input, output, exception = select.select(input_list, [], [])
-    
-        for socket in input:
+
+        for sock in input:
             # accept client and add it to list input
-            if socket == server_socket:            
+            if sock == server_socket:
                 client_socket, client_address = server_socket.accept()
                 input_list.append(client_socket)
-                print "Accepted client: ", client_address                           
-            
-            # handle sending and receiving message    
-            else:                                        
-                message = socket.recv(1024)
-                if message:                                    
-                    socket.send(message)
-                    print "Send to client : ", client_address, message                    
-                else:                    
-                    socket.close()                    
-                    input_list.remove(socket)
+                if counters is None:
+                    print "Accepted client: ", client_address
+
+            # handle sending and receiving message
+            else:
+                message = sock.recv(1024)
+                if message:
+                    sock.send(message)
+                    if counters is None:
+                        print "Send to client : ", sock.getpeername(), message
+                    else:
+                        # publish this worker's totals to the supervisor
+                        messages += 1
+                        total_bytes += len(message)
+                        COUNTER.pack_into(counters, slot * COUNTER.size, messages, total_bytes)
+                else:
+                    sock.close()
+                    input_list.remove(sock)
+
+
+def run_worker(counters, slot):
+    # runs in the forked child, never returns
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    status = 0
+    try:
+        serve(create_server(reuse_port=True), counters, slot)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print "Worker", os.getpid(), "crashed:", e
+        status = 1
+    os._exit(status)
+
+
+def supervise(workers, interval):
+    # fork the workers, restart any that die and print the aggregate
+    # throughput every interval seconds
+    counters = mmap.mmap(-1, workers * COUNTER.size)
+    pids = {}
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(counters, slot)
+        pids[pid] = slot
+
+    for slot in range(workers):
+        spawn(slot)
+    print "Started", workers, "workers on port 5000"
+
+    last_time = time.time()
+    last_messages = last_bytes = 0
+    try:
+        while 1:
+            time.sleep(0.1)
+            while 1:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                slot = pids.pop(pid)
+                print "Worker", pid, "exited with status", status, "restarting"
+                spawn(slot)
+
+            now = time.time()
+            if now - last_time >= interval:
+                messages = total_bytes = 0
+                for slot in range(workers):
+                    m, b = COUNTER.unpack_from(counters, slot * COUNTER.size)
+                    messages += m
+                    total_bytes += b
+                elapsed = now - last_time
+                print "%.0f msg/s %.2f MB/s" % ((messages - last_messages) / elapsed,
+                                               (total_bytes - last_bytes) / elapsed / 1e6)
+                last_time, last_messages, last_bytes = now, messages, total_bytes
+
+    # when user press CTRL + C (in Linux), stop the workers
+    except KeyboardInterrupt:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+
+parser = argparse.ArgumentParser(description='echo server with multi client support')
+parser.add_argument('--workers', type=int, default=0,
+                    help='fork this many SO_REUSEPORT worker processes')
+parser.add_argument('--report', type=float, default=5,
+                    help='seconds between throughput reports in worker mode')
+args = parser.parse_args()
+
+if args.workers > 0:
+    supervise(args.workers, args.report)
+    sys.exit(0)
+
+server_socket = create_server()
+
+try:
+    serve(server_socket)
 
 # when user press CTRL + C (in Linux), close socket server and exit
 except KeyboardInterrupt:
     server_socket.close()
-    sys.exit(0)
\ No newline at end of file
+    sys.exit(0)